@@ -0,0 +1,181 @@
+"""Benchmark for the three matching methods of the faceted search use case.
+Usage:
+  python benchmark.py [--events N] [--queries N] [--venues N] [--categories N]
+
+N synthetic events are generated and, for each method in turn, indexed into a
+clean database and queried with the same random mix of queries. For each method
+the following are reported:
+
+  * p50 and p99 latency of a query
+  * commands run by Redis per query, from INFO commandstats
+  * round trips to Redis per query, counted on the client connection
+  * memory used by the events and their index, from INFO memory
+
+Part of Redis University RU101 courseware"""
+from redis import Redis, ConnectionPool, Connection
+import json
+import os
+import random
+import sys
+import time
+import search
+import redisu.ru101.common.generate as generate
+import redisu.utils.keynamehelper as keynamehelper
+
+__methods__ = ['inspection', 'facets', 'hashed']
+
+
+class CountingConnection(Connection):
+  """Connection that counts the requests sent to Redis. A pipeline is sent in
+a single request, so this is the number of round trips."""
+  round_trips = 0
+
+  def send_packed_command(self, command, check_health=True):
+    CountingConnection.round_trips += 1
+    super().send_packed_command(command, check_health)
+
+def generate_events(count, venues, categories, rand):
+  """Generator returning count events, with values for venue and category
+chosen from venues and categories distinct values"""
+  for i in range(count):
+    yield {'sku': generate.sku(),
+           'name': "Event {}".format(i),
+           'disabled_access': rand.random() < 0.5,
+           'medal_event': rand.random() < 0.2,
+           'venue': "Venue {}".format(rand.randrange(venues)),
+           'category': "Category {}".format(rand.randrange(categories)),
+           'capacity': rand.randrange(1000, 100000),
+           'price': round(rand.uniform(5, 500), 2)
+          }
+
+def generate_queries(count, venues, rand):
+  """Return count queries, each of between one and three of the attributes in
+search.__lookup_attrs__"""
+  values = {'disabled_access': lambda: rand.random() < 0.5,
+            'medal_event': lambda: rand.random() < 0.5,
+            'venue': lambda: "Venue {}".format(rand.randrange(venues))}
+  queries = []
+  for _ in range(count):
+    attrs = rand.sample(sorted(values), rand.randint(1, len(values)))
+    queries.append([(attr, values[attr]()) for attr in attrs])
+  return queries
+
+def command_count(redis):
+  """Return the number of commands Redis has run, less those of INFO"""
+  stats = redis.info("commandstats")
+  return sum(stat['calls'] for name, stat in stats.items()
+             if name != "cmdstat_info")
+
+def used_memory(redis):
+  """Return the number of bytes of memory used by Redis"""
+  return redis.info("memory")['used_memory']
+
+def build(method, events):
+  """Write the events and the index used by the method. The facets and hashed
+methods both use index_events, which also writes the sort indexes, so their
+memory includes those."""
+  if method == "inspection":
+    p = search.redis.pipeline(transaction=False)
+    for i, event in enumerate(events, 1):
+      p.set(keynamehelper.create_key_name("event", event['sku']),
+            json.dumps(event))
+      if i % search.__batch_size__ == 0:
+        p.execute()
+    p.execute()
+  else:
+    search.index_events(events, hashed=(method == "hashed"))
+
+def run_queries(method, queries):
+  """Run each query with the method, returning the latency of each in
+seconds"""
+  matcher = {'inspection': search.match_by_inspection,
+             'facets': search.match_by_faceting,
+             'hashed': search.match_by_hashed_faceting}[method]
+  latencies = []
+  for query in queries:
+    start = time.perf_counter()
+    matcher(*query)
+    latencies.append(time.perf_counter() - start)
+  return latencies
+
+def percentile(samples, pct):
+  """Return the pct percentile of the samples, by the nearest rank"""
+  ordered = sorted(samples)
+  return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def benchmark(method, events, queries):
+  """Build the index for the method in a clean database and run the queries.
+Returns a dict of the results."""
+  from redisu.utils.clean import clean_keys
+
+  redis = search.redis
+  clean_keys(redis)
+  memory = used_memory(redis)
+  build(method, events)
+  memory = used_memory(redis) - memory
+
+  commands = command_count(redis)
+  round_trips = CountingConnection.round_trips
+  latencies = run_queries(method, queries)
+  round_trips = CountingConnection.round_trips - round_trips
+  commands = command_count(redis) - commands
+  return {'method': method,
+          'p50': percentile(latencies, 50),
+          'p99': percentile(latencies, 99),
+          'commands': commands / len(queries),
+          'round_trips': round_trips / len(queries),
+          'memory': memory}
+
+def print_results(results):
+  """Print a table of the results of each method"""
+  print("{:<12}{:>12}{:>12}{:>12}{:>14}{:>14}".format(
+      "method", "p50 (ms)", "p99 (ms)", "cmds/query", "trips/query",
+      "memory (KB)"))
+  for res in results:
+    print("{:<12}{:>12.3f}{:>12.3f}{:>12.1f}{:>14.1f}{:>14.0f}".format(
+        res['method'], res['p50'] * 1000, res['p99'] * 1000, res['commands'],
+        res['round_trips'], res['memory'] / 1024))
+
+def main(argv):
+  """Entry point, to run the benchmark from the command line"""
+  import argparse
+  from redisu.utils.clean import clean_keys
+
+  parser = argparse.ArgumentParser(
+      description="Benchmark the faceted search matching methods")
+  parser.add_argument("--events", type=int, default=10000,
+                      help="number of events to generate")
+  parser.add_argument("--queries", type=int, default=200,
+                      help="number of queries to run for each method")
+  parser.add_argument("--venues", type=int, default=50,
+                      help="number of distinct venues")
+  parser.add_argument("--categories", type=int, default=20,
+                      help="number of distinct categories")
+  parser.add_argument("--method", action="append", choices=__methods__,
+                      help="method to benchmark, may be repeated")
+  parser.add_argument("--seed", type=int, default=101,
+                      help="seed for the generated events and queries")
+  args = parser.parse_args(argv)
+
+  pool = ConnectionPool(connection_class=CountingConnection,
+                        host=os.environ.get("REDIS_HOST", "localhost"),
+                        port=os.environ.get("REDIS_PORT", 6379),
+                        password=os.environ.get("REDIS_PASSWORD", None),
+                        db=0)
+  search.redis = Redis(connection_pool=pool)
+
+  rand = random.Random(args.seed)
+  generate.__fake__.seed_instance(args.seed)
+  events = list(generate_events(args.events, args.venues, args.categories,
+                                rand))
+  queries = generate_queries(args.queries, args.venues, rand)
+  print("{} events, {} queries, {} venues".format(args.events, args.queries,
+                                                  args.venues))
+  results = [benchmark(method, events, queries)
+             for method in args.method or __methods__]
+  clean_keys(search.redis)
+  print_results(results)
+
+if __name__ == "__main__":
+  keynamehelper.set_prefix("uc01bench")
+  main(sys.argv[1:])
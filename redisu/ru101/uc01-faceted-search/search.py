@@ -9,26 +9,35 @@ import redisu.utils.keynamehelper as keynamehelper
 
 redis = None
 
+# Number of events read by each MGET in hydrate_events
+__hydrate_chunk__ = 500
+
 __events__ = [{'sku': "123-ABC-723",
                'name': "Men's 100m Final",
                'disabled_access': True,
                'medal_event': True,
                'venue': "Olympic Stadium",
-               'category': "Track & Field"
+               'category': "Track & Field",
+               'capacity': 60102,
+               'price': 25.00
               },
               {'sku': "737-DEF-911",
                'name': "Women's 4x100m Heats",
                'disabled_access': True,
                'medal_event': False,
                'venue': "Olympic Stadium",
-               'category': "Track & Field"
+               'category': "Track & Field",
+               'capacity': 60102,
+               'price': 19.50
               },
               {'sku': "320-GHI-921",
                'name': "Womens Judo Qualifying",
                'disabled_access': False,
                'medal_event': False,
                'venue': "Nippon Budokan",
-               'category': "Martial Arts"
+               'category': "Martial Arts",
+               'capacity': 14471,
+               'price': 15.25
               }
              ]
 
@@ -44,24 +53,59 @@ def print_event_name(event_sku):
   event = json.loads(redis.get(key))
   print((event['name'] if ('name' in event) else event['sku']))
 
+def hydrate_events(skus, fields=None, chunk_size=__hydrate_chunk__):
+  """Fetch the event documents for a set of search results. The keys are read
+with one MGET per chunk_size events, all sent in a single pipeline, and the
+documents are decoded in one pass. If fields is given, only those attributes
+of each event are returned. Events that no longer exist are left out. Returns
+a list of the events, in the order of skus."""
+  skus = list(skus)
+  p = redis.pipeline(transaction=False)
+  for i in range(0, len(skus), chunk_size):
+    p.mget([keynamehelper.create_key_name("event", sku)
+            for sku in skus[i:i + chunk_size]])
+  events = [json.loads(doc) for docs in p.execute() for doc in docs
+            if doc is not None]
+  if fields is not None:
+    events = [{f: event[f] for f in fields if f in event} for event in events]
+  return events
+
+def print_event_names(event_skus):
+  """Helper to print the names of a set of events, fetched with
+hydrate_events"""
+  for event in hydrate_events(event_skus, fields=('name', 'sku')):
+    print((event['name'] if ('name' in event) else event['sku']))
+
+def event_matches(event, keys):
+  """Return True if the event has every (attribute, value) pair in keys"""
+  for key, val in keys:
+    if key not in event or event[key] != val:
+      return False
+  return True
+
 def match_by_inspection(*keys):
   """Match Method 1 - Object inspection
   Find all matching keys, retreive value and then exeamine for all macthing
-  attributes."""
+  attributes. The events on each page of keys returned by SCAN are read with
+  one MGET, pipelined with the SCAN for the next page, and each page is
+  decoded and filtered in a single pass."""
   matches = []
-  key = keynamehelper.create_key_name("event", "*")
-  for key in redis.scan_iter(match=key, count=1000):
-    match = False
-    event = json.loads(redis.get(key))
-    for keyval in keys:
-      key, val = keyval
-      if key in event and event[key] == val:
-        match = True
-      else:
-        match = False
-        break
-    if match:
-        matches.append(event['sku'])
+  match = keynamehelper.create_key_name("event", "*")
+  p = redis.pipeline(transaction=False)
+  cursor, page = redis.scan(0, match=match, count=1000)
+  while True:
+    if page:
+      p.mget(page)
+    if cursor != 0:
+      p.scan(cursor, match=match, count=1000)
+    res = p.execute()
+    if page:
+      events = [json.loads(doc) for doc in res[0] if doc is not None]
+      matches.extend(event['sku'] for event in events
+                     if event_matches(event, keys))
+    if cursor == 0:
+      break
+    cursor, page = res[-1]
   return matches
 
 def test_object_inspection():
@@ -73,38 +117,123 @@ def test_object_inspection():
   # Find the match
   print("=== disabled_access=True")
   matches = match_by_inspection(('disabled_access', True))
-  for match in matches:
-    print_event_name(match)
+  print_event_names(matches)
 
   print("=== disabled_access=True, medal_event=False")
   matches = match_by_inspection(('disabled_access', True),
                                 ('medal_event', False))
-  for match in matches:
-    print_event_name(match)
+  print_event_names(matches)
 
   print("=== disabled_access=False, medal_event=False, venue='Nippon Budokan'")
   matches = match_by_inspection(('disabled_access', False),
                                 ('medal_event', False),
                                 ('venue', "Nippon Budokan"))
-  for match in matches:
-    print_event_name(match)
+  print_event_names(matches)
 
 
 __lookup_attrs__ = ['disabled_access', 'medal_event', 'venue', 'tbd']
+# Number of events written per pipeline by index_events
+__batch_size__ = 500
+# Seconds that a query result is cached for, when asked to
+__query_ttl__ = 10
+# Numeric attributes with a Sorted Set index, that search results can be
+# sorted by. A score cannot order strings, so text attributes are not included.
+__sort_attrs__ = ['price', 'capacity']
+# Numeric attributes of __sort_attrs__, whose index can be queried by range
+__range_attrs__ = ['price', 'capacity']
+# Events per page, and seconds a result is kept for paging, in search_page
+__page_size__ = 20
+__page_ttl__ = 60
 
 def create_events_with_lookups(e_array):
   """Match method 2 - Faceted Search
 For each attribute & value combination, add the event into a Set"""
-  for i in range(len(e_array)):
-    key = keynamehelper.create_key_name("event", e_array[i]['sku'])
-    redis.set(key, json.dumps(e_array[i]))
-    for k in range(len(__lookup_attrs__)):
-      if __lookup_attrs__[k] in e_array[i]:
-        attr_name = str(e_array[i][__lookup_attrs__[k]])
-        fs_key = keynamehelper.create_key_name("fs",
-                                               __lookup_attrs__[k],
-                                               attr_name)
-        redis.sadd(fs_key, e_array[i]['sku'])
+  index_events(e_array)
+
+def facet_keys(event):
+  """Return the keys of the facet Sets that the event belongs in"""
+  return {keynamehelper.create_key_name("fs", attr, str(event[attr]))
+          for attr in __lookup_attrs__ if attr in event}
+
+def index_events(e_iter, batch_size=__batch_size__, reindex=False,
+                 hashed=False):
+  """Bulk indexer for faceted search. Events from any iterable are written,
+with their facet Sets and sort indexes, batch_size events per pipeline. If
+hashed is set, the hashed facet Sets are written too. If reindex is set, events
+are removed from the Sets of values they no longer have. Returns the number of
+events indexed."""
+  count = 0
+  batch = []
+  for event in e_iter:
+    batch.append(event)
+    if len(batch) >= batch_size:
+      count += _index_batch(batch, reindex, hashed)
+      batch = []
+  if batch:
+    count += _index_batch(batch, reindex, hashed)
+  return count
+
+def sort_score(val):
+  """Return the score that orders a numeric attribute value in a sort index"""
+  return float(val)
+
+def sort_scores(event):
+  """Return the score of the event in the sort index of each attribute in
+__sort_attrs__ that it has, keyed by the name of the index"""
+  return {keynamehelper.create_key_name("fz", attr): sort_score(event[attr])
+          for attr in __sort_attrs__ if attr in event}
+
+def _index_batch(batch, reindex, hashed=False):
+  """Write one batch of events, their facet Sets and sort indexes, see
+index_events"""
+  from collections import defaultdict
+
+  def set_keys(event):
+    return facet_keys(event) | (hashed_keys(event) if hashed else set())
+
+  keys = [keynamehelper.create_key_name("event", e['sku']) for e in batch]
+  removals = defaultdict(list)
+  z_removals = defaultdict(list)
+  if reindex:
+    # Compare with the stored events, read with one MGET for the batch
+    for event, old in zip(batch, redis.mget(keys)):
+      if old is not None:
+        old = json.loads(old)
+        for fs_key in set_keys(old) - set_keys(event):
+          removals[fs_key].append(event['sku'])
+        for fz_key in set(sort_scores(old)) - set(sort_scores(event)):
+          z_removals[fz_key].append(event['sku'])
+  additions = defaultdict(list)
+  z_additions = defaultdict(dict)
+  values = defaultdict(set)
+  # One pipeline for the batch: a SET per event, then one variadic command per
+  # Set or Sorted Set changed
+  p = redis.pipeline(transaction=False)
+  for key, event in zip(keys, batch):
+    p.set(key, json.dumps(event))
+    for fs_key in set_keys(event):
+      additions[fs_key].append(event['sku'])
+    # The values seen for each attribute, for facet_counts
+    for attr in __lookup_attrs__:
+      if attr in event:
+        values[attr].add(str(event[attr]))
+    for fz_key, score in sort_scores(event).items():
+      z_additions[fz_key][event['sku']] = score
+  for fs_key, skus in removals.items():
+    p.srem(fs_key, *skus)
+  for fs_key, skus in additions.items():
+    p.sadd(fs_key, *skus)
+  for fz_key, skus in z_removals.items():
+    p.zrem(fz_key, *skus)
+  for fz_key, scores in z_additions.items():
+    p.zadd(fz_key, scores)
+  for attr, vals in values.items():
+    p.sadd(keynamehelper.create_key_name("fv", attr), *vals)
+  # Tell QueryCache instances which Sets have changed, as a JSON array
+  changed = sorted(set(additions) | set(removals))
+  p.publish(keynamehelper.create_key_name("fs_changed"), json.dumps(changed))
+  p.execute()
+  return len(batch)
 
 def match_by_faceting(*keys):
   """Use SINTER to find the matching elements"""
@@ -115,6 +244,254 @@ def match_by_faceting(*keys):
     facets.append(fs_key)
   return redis.sinter(facets)
 
+def normalize_query(keys):
+  """Return the (attribute, value) pairs of a query in a canonical order, with
+the values as strings, so equivalent queries are recognised as the same"""
+  return sorted((attr, str(val)) for attr, val in keys)
+
+def query_by_faceting(*keys, cache_ttl=None):
+  """Query engine for faceted search. The cardinality of every facet Set is
+read first, in one pipelined round trip, so a query with an empty facet
+returns without intersecting anything, and the Sets are passed to SINTER
+smallest first.
+
+By default every query reads the facet Sets. If cache_ttl is given, for
+example __query_ttl__, the result is stored with SINTERSTORE under a key named
+after the normalized query, which expires after cache_ttl seconds. Repeats of
+the query within that time are answered from the stored Set, which is read in
+the same round trip as the cardinalities. Results can be up to cache_ttl
+seconds out of date."""
+  query = normalize_query(keys)
+  if not query:
+    return set()
+  facets = [keynamehelper.create_key_name("fs", attr, val)
+            for attr, val in query]
+  cache_key = keynamehelper.create_key_name("fq",
+                                            *[x for pair in query for x in pair])
+  p = redis.pipeline(transaction=False)
+  if cache_ttl:
+    p.smembers(cache_key)
+  for fs_key in facets:
+    p.scard(fs_key)
+  cards = p.execute()
+  if cache_ttl:
+    cached = cards.pop(0)
+    if cached:
+      return cached
+  if min(cards) == 0:
+    return set()
+  ordered = [fs_key for _, fs_key in sorted(zip(cards, facets))]
+  if not cache_ttl:
+    return redis.sinter(ordered)
+  p.sinterstore(cache_key, ordered)
+  p.expire(cache_key, cache_ttl)
+  p.smembers(cache_key)
+  return p.execute()[-1]
+
+def match_by_range(*keys, ranges=(), cache_ttl=None):
+  """Match events on equality facets, given as (attribute, value) pairs, and
+on numeric ranges, given as (attribute, min, max) tuples for attributes in
+__range_attrs__. As for ZRANGEBYSCORE, min and max are inclusive unless
+prefixed with "(" and may be "-inf" or "+inf".
+
+All the work is done server side, in a single transaction: each range is
+copied out of the attribute's Sorted Set index with ZRANGESTORE BYSCORE into a
+temporary key, the temporary keys and the facet Sets are intersected with
+ZINTERSTORE, and the result is read and the temporary keys removed. Matches are
+returned ordered by the attribute of the first range. Without ranges the query
+is passed to query_by_faceting, with cache_ttl."""
+  import uuid
+
+  if not ranges:
+    return list(query_by_faceting(*keys, cache_ttl=cache_ttl))
+  for attr, _, _ in ranges:
+    if attr not in __range_attrs__:
+      raise ValueError("{} is not a range attribute".format(attr))
+  tmp = keynamehelper.create_key_name("ftmp", uuid.uuid4().hex)
+  sources = {}
+  p = redis.pipeline()
+  for i, (attr, low, high) in enumerate(ranges):
+    range_key = keynamehelper.create_field_name(tmp, str(i))
+    p.zrangestore(range_key, keynamehelper.create_key_name("fz", attr),
+                  low, high, byscore=True)
+    sources[range_key] = 1 if i == 0 else 0
+  for attr, val in normalize_query(keys):
+    sources[keynamehelper.create_key_name("fs", attr, val)] = 0
+  p.zinterstore(tmp, sources)
+  p.zrange(tmp, 0, -1)
+  p.delete(tmp, *[key for key in sources if key.startswith(tmp)])
+  return p.execute()[-2]
+
+def facet_counts(*keys, cache_ttl=__query_ttl__):
+  """Drill-down counts for faceted search. For each attribute in
+__lookup_attrs__ that is not already in the filter keys, return the number of
+matching events for each of its values, as {attribute: {value: count}}.
+
+The known values of every attribute are read in one pipelined round trip, and
+all the counts are computed server side with SINTERCARD of the filter's facet
+Sets and the value's facet Set, in a second one. If cache_ttl is set, the
+counts are stored under a key named after the normalized filter for cache_ttl
+seconds, and read in the first round trip of a repeat request."""
+  query = normalize_query(keys)
+  filtered = {attr for attr, _ in query}
+  attrs = [attr for attr in __lookup_attrs__ if attr not in filtered]
+  facets = [keynamehelper.create_key_name("fs", attr, val)
+            for attr, val in query]
+  cache_key = keynamehelper.create_key_name("fc",
+                                            *[x for pair in query for x in pair])
+  p = redis.pipeline(transaction=False)
+  if cache_ttl:
+    p.get(cache_key)
+  for attr in attrs:
+    p.smembers(keynamehelper.create_key_name("fv", attr))
+  res = p.execute()
+  if cache_ttl:
+    cached = res.pop(0)
+    if cached is not None:
+      return json.loads(cached)
+  values = []
+  for attr, vals in zip(attrs, res):
+    for val in sorted(v.decode() if isinstance(v, bytes) else v for v in vals):
+      fs_key = keynamehelper.create_key_name("fs", attr, val)
+      if facets:
+        p.sintercard(len(facets) + 1, facets + [fs_key])
+      else:
+        p.scard(fs_key)
+      values.append((attr, val))
+  counts = {attr: {} for attr in attrs}
+  for (attr, val), count in zip(values, p.execute()):
+    counts[attr][val] = count
+  if cache_ttl:
+    redis.set(cache_key, json.dumps(counts), ex=cache_ttl)
+  return counts
+
+def search_page(*keys, sort_by=None, desc=False, cursor=0,
+                page_size=__page_size__):
+  """Return a page of the SKUs of the events that match the facets, sorted by
+the attribute sort_by, or by SKU if it is None, and the cursor for the next
+page, which is 0 once there are no more."""
+  import uuid
+
+  query = normalize_query(keys)
+  if not query and sort_by is None:
+    raise ValueError("search_page needs facets, sort_by or both")
+  if sort_by is not None and sort_by not in __sort_attrs__:
+    raise ValueError("{} is not a sort attribute".format(sort_by))
+  # The facets have a weight of 0, so the score of a match is its sort score
+  sources = {keynamehelper.create_key_name("fs", attr, val): 0
+             for attr, val in query}
+  if sort_by is not None:
+    sources[keynamehelper.create_key_name("fz", sort_by)] = 1
+  # The result is kept under a key of its own, named by a token in the cursor,
+  # so pages stay stable while the data changes or others run the same query
+  if cursor == 0:
+    token, offset = uuid.uuid4().hex, 0
+  else:
+    token, offset = cursor.rsplit(":", 1)
+    offset = int(offset)
+  result_key = keynamehelper.create_key_name("fp", token)
+  p = redis.pipeline(transaction=False)
+  if cursor == 0:
+    p.zinterstore(result_key, sources)
+  # Keep the result for __page_ttl__ seconds from the last page read
+  p.expire(result_key, __page_ttl__)
+  # Read one extra event, to know if there is a following page
+  p.zrange(result_key, offset, offset + page_size, desc=desc)
+  res = p.execute()
+  if cursor != 0 and not res[-2]:
+    # The stored result has expired, rebuild it
+    p.zinterstore(result_key, sources)
+    p.expire(result_key, __page_ttl__)
+    p.zrange(result_key, offset, offset + page_size, desc=desc)
+    res = p.execute()
+  skus = res[-1]
+  if len(skus) > page_size:
+    return skus[:page_size], "{}:{}".format(token, offset + page_size)
+  return skus, 0
+
+class QueryCache(object):
+  """In-process cache in front of match_by_faceting, for queries repeated many
+times a second. Results are kept for up to ttl seconds, and the least recently
+used are evicted once there are max_size of them.
+
+Call listen to start a thread that subscribes to the fs_changed channel, which
+index_events publishes to, and drops every cached result that depends on a
+facet Set that has changed. A query that is running when an invalidation
+arrives does not store its result, so a result computed before a change is
+never cached after it. If the subscription is lost, results are at most ttl
+seconds out of date."""
+
+  def __init__(self, max_size=1024, ttl=5.0):
+    import threading
+    from collections import OrderedDict
+
+    self.max_size = max_size
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+    self._generation = 0
+    self._channel = keynamehelper.create_key_name("fs_changed")
+
+  def match(self, *keys):
+    """Return the result of match_by_faceting for the query, from the cache if
+    possible"""
+    import time
+
+    query = tuple(normalize_query(keys))
+    now = time.time()
+    with self._lock:
+      entry = self._entries.get(query)
+      if entry is not None and entry[0] > now:
+        self._entries.move_to_end(query)
+        self.hits += 1
+        return entry[2]
+      self.misses += 1
+      generation = self._generation
+    result = frozenset(match_by_faceting(*query))
+    facets = {keynamehelper.create_key_name("fs", attr, val)
+              for attr, val in query}
+    with self._lock:
+      if generation == self._generation:
+        self._entries[query] = (now + self.ttl, facets, result)
+        self._entries.move_to_end(query)
+        while len(self._entries) > self.max_size:
+          self._entries.popitem(last=False)
+    return result
+
+  def invalidate(self, fs_keys=None):
+    """Drop the cached results that depend on any of the facet Set keys, or
+    every result if fs_keys is None"""
+    fs_keys = None if fs_keys is None else set(fs_keys)
+    with self._lock:
+      self._generation += 1
+      if fs_keys is None:
+        self._entries.clear()
+      else:
+        for query in [query for query, entry in self._entries.items()
+                      if not entry[1].isdisjoint(fs_keys)]:
+          del self._entries[query]
+
+  def listen(self):
+    """Start a daemon thread that invalidates results when index_events
+    changes a facet Set. Returns once the subscription is in place."""
+    import threading
+
+    l = redis.pubsub(ignore_subscribe_messages=True)
+    l.subscribe(self._channel)
+    l.get_message(timeout=1)
+
+    def run():
+      for message in l.listen():
+        data = message['data']
+        self.invalidate(json.loads(data.decode() if isinstance(data, bytes)
+                                   else data))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
 def test_faceted_search():
   """Test function for Method 2: Faceted Search"""
   print("\n== Method 2: Faceted Search")
@@ -123,48 +500,58 @@ def test_faceted_search():
   # Find the match
   print("=== disabled_access=True")
   matches = match_by_faceting(('disabled_access', True))
-  for match in matches:
-    print_event_name(match)
+  print_event_names(matches)
 
   print("=== disabled_access=True, medal_event=False")
   matches = match_by_faceting(('disabled_access', True), ('medal_event', False))
-  for match in matches:
-    print_event_name(match)
+  print_event_names(matches)
 
   print("=== disabled_access=False, medal_event=False, venue='Nippon Budokan'")
   matches = match_by_faceting(('disabled_access', False),
                               ('medal_event', False),
                               ('venue', "Nippon Budokan"))
-  for match in matches:
-    print_event_name(match)
+  print_event_names(matches)
+
+  print("=== medal_event=False, disabled_access=True (cached for {}s)"\
+    .format(__query_ttl__))
+  for _ in range(2):
+    matches = query_by_faceting(('medal_event', False),
+                                ('disabled_access', True),
+                                cache_ttl=__query_ttl__)
+  print_event_names(matches)
 
 # Match method 3 - Hashed Faceted Search
+def hashed_key(pairs):
+  """Return the hashed facet key for a list of (attribute, value) pairs, given
+in __lookup_attrs__ order. A 128 bit BLAKE2b digest is used, which is cheaper
+to compute than SHA-256 and keeps every key the same length."""
+  digest = hashlib.blake2b(repr(pairs).encode('utf-8'), digest_size=16)
+  return keynamehelper.create_key_name("hfs", digest.hexdigest())
+
+def hashed_keys(event):
+  """Return the hashed facet keys the event belongs in, one for every
+combination of the attributes in __lookup_attrs__ that it has, so that a query
+on any subset of them is a lookup of a single key"""
+  from itertools import combinations
+
+  pairs = [(attr, str(event[attr])) for attr in __lookup_attrs__
+           if attr in event]
+  return {hashed_key(list(combo))
+          for size in range(1, len(pairs) + 1)
+          for combo in combinations(pairs, size)}
+
 def create_events_hashed_lookups(e_array):
   """Create hashed lookup for each event"""
-  for i in range(len(e_array)):
-    key = keynamehelper.create_key_name("event", e_array[i]['sku'])
-    redis.set(key, json.dumps(e_array[i]))
-    hfs = []
-    for key in range(len(__lookup_attrs__)):
-      if __lookup_attrs__[key] in e_array[i]:
-        hfs.append((__lookup_attrs__[key], e_array[i][__lookup_attrs__[key]]))
-      hashed_val = hashlib.sha256(str(hfs).encode('utf-8')).hexdigest()
-      hfs_key = keynamehelper.create_key_name("hfs", hashed_val)
-      redis.sadd(hfs_key, e_array[i]['sku'])
+  index_events(e_array, hashed=True)
 
 def match_by_hashed_faceting(*keys):
   """Match method 3 - Hashed Faceted Search"""
-  matches = []
   hfs = []
   for i in range(len(__lookup_attrs__)):
     key = [x for x in keys if x[0] == __lookup_attrs__[i]]
     if key:
-      hfs.append(key[0])
-  hashed_val = hashlib.sha256(str(hfs).encode('utf-8')).hexdigest()
-  hashed_key = keynamehelper.create_key_name("hfs", hashed_val)
-  for found_key in redis.sscan_iter(hashed_key, count=1000):
-    matches.append(found_key)
-  return matches
+      hfs.append((key[0][0], str(key[0][1])))
+  return list(redis.smembers(hashed_key(hfs)))
 
 def test_hashed_faceting():
   """Test function for Method 3: Hashed Faceting"""
@@ -174,21 +561,118 @@ def test_hashed_faceting():
   # Find the match
   print("=== disabled_access=True")
   matches = match_by_hashed_faceting(('disabled_access', True))
-  for match in matches:
-    print_event_name(match)
+  print_event_names(matches)
 
   print("=== disabled_access=True, medal_event=False")
   matches = match_by_hashed_faceting(('disabled_access', True),
                                      ('medal_event', False))
-  for match in matches:
-    print_event_name(match)
+  print_event_names(matches)
 
   print("=== disabled_access=False, medal_event=False, venue='Nippon Budokan'")
   matches = match_by_hashed_faceting(('disabled_access', False),
                                      ('medal_event', False),
                                      ('venue', "Nippon Budokan"))
-  for match in matches:
-    print_event_name(match)
+  print_event_names(matches)
+
+def test_search_page():
+  """Test function for paginated, sorted search results"""
+  print("\n== Paginated search")
+  print("=== disabled_access=True, sorted by price, 1 per page")
+  cursor = None
+  while cursor != 0:
+    page, cursor = search_page(('disabled_access', True), sort_by='price',
+                               cursor=cursor or 0, page_size=1)
+    for event in hydrate_events(page, fields=('name', 'price')):
+      print("{} ${:.2f}".format(event['name'], event['price']))
+
+  print("=== all events, sorted by capacity descending")
+  page, cursor = search_page(sort_by='capacity', desc=True)
+  print_event_names(page)
+
+def test_facet_counts():
+  """Test function for drill-down facet counts"""
+  print("\n== Facet counts")
+  print("=== medal_event=False")
+  counts = facet_counts(('medal_event', False))
+  for attr in sorted(counts):
+    for val, count in sorted(counts[attr].items()):
+      print("{}={}: {}".format(attr, val, count))
+
+def test_range_search():
+  """Test function for range facets"""
+  print("\n== Range facets")
+  print("=== venue='Olympic Stadium', 20 <= price <= 30")
+  print_event_names(match_by_range(('venue', "Olympic Stadium"),
+                                   ranges=[('price', 20, 30)]))
+
+  print("=== medal_event=False, capacity > 20000")
+  print_event_names(match_by_range(('medal_event', False),
+                                   ranges=[('capacity', "(20000", "+inf")]))
+
+  print("=== price < 20, capacity <= 60102")
+  print_event_names(match_by_range(ranges=[('price', "-inf", "(20"),
+                                           ('capacity', "-inf", 60102)]))
+
+def test_query_cache():
+  """Test function for the client-side query cache"""
+  import time
+
+  print("\n== Query cache")
+  cache = QueryCache()
+  cache.listen()
+  print("=== venue='Nippon Budokan', 1000 times")
+  for _ in range(1000):
+    matches = cache.match(('venue', "Nippon Budokan"))
+  print_event_names(matches)
+  print("hits: {}, misses: {}".format(cache.hits, cache.misses))
+
+  print("=== move Men's 100m Final to Nippon Budokan, and query again")
+  moved = dict(__events__[0], venue="Nippon Budokan")
+  index_events([moved], reindex=True)
+  time.sleep(0.1)
+  print_event_names(cache.match(('venue', "Nippon Budokan")))
+  print("hits: {}, misses: {}".format(cache.hits, cache.misses))
+  index_events([__events__[0]], reindex=True)
+
+def match(*keys, cache_ttl=None):
+  """Query planner. Attributes in __lookup_attrs__ are answered from the facet
+Sets with query_by_faceting. If the query also has unindexed attributes, only
+the events matched by the indexed ones are read, with hydrate_events, and
+filtered on the rest. Only a query with no indexed attributes falls back to
+match_by_inspection. Returns the plan chosen, one of "facets",
+"facets+filter" or "inspection", and the matching SKUs.
+
+By default results always reflect the current facet Sets. If cache_ttl is set,
+the facet part of the query is cached by query_by_faceting, and results can be
+up to cache_ttl seconds out of date."""
+  indexed = [kv for kv in keys if kv[0] in __lookup_attrs__]
+  unindexed = [kv for kv in keys if kv[0] not in __lookup_attrs__]
+  if not unindexed:
+    return "facets", list(query_by_faceting(*indexed, cache_ttl=cache_ttl))
+  if indexed:
+    events = hydrate_events(query_by_faceting(*indexed, cache_ttl=cache_ttl))
+    return "facets+filter", [event['sku'] for event in events
+                             if event_matches(event, unindexed)]
+  return "inspection", match_by_inspection(*unindexed)
+
+def test_query_planner():
+  """Test function for the query planner"""
+  print("\n== Query planner")
+  print("=== venue='Olympic Stadium'")
+  plan, matches = match(('venue', "Olympic Stadium"))
+  print("plan: {}".format(plan))
+  print_event_names(matches)
+
+  print("=== venue='Olympic Stadium', name=\"Men's 100m Final\"")
+  plan, matches = match(('venue', "Olympic Stadium"),
+                        ('name', "Men's 100m Final"))
+  print("plan: {}".format(plan))
+  print_event_names(matches)
+
+  print("=== category='Martial Arts'")
+  plan, matches = match(('category', "Martial Arts"))
+  print("plan: {}".format(plan))
+  print_event_names(matches)
 
 def main():
   """ Main, used to call test cases for this use case"""
@@ -205,6 +689,11 @@ def main():
   test_object_inspection()
   test_faceted_search()
   test_hashed_faceting()
+  test_query_planner()
+  test_search_page()
+  test_facet_counts()
+  test_range_search()
+  test_query_cache()
 
 if __name__ == "__main__":
   keynamehelper.set_prefix("uc01")
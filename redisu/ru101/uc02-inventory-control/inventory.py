@@ -3,12 +3,24 @@ Usage:
 Part of Redis University RU101 courseware"""
 from redis import Redis, WatchError
 import os
+import random
+import threading
 import time
 import redisu.utils.keynamehelper as keynamehelper
 import redisu.ru101.common.generate as generate
 
 redis = None
 
+# First and largest backoff, and the seconds to keep retrying, after a WATCH
+# conflict in transaction
+__retry_base__ = 0.001
+__retry_cap__ = 0.1
+__retry_deadline__ = 2.0
+# Upper bounds, in seconds, of the buckets of the transaction latency histogram
+__latency_buckets__ = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1]
+# Number of expired holds released at a time by expire_reservations
+__expiry_batch__ = 100
+
 customers = [{'id': "bill", 'customer_name': "bill smith"},
              {'id': "mary", 'customer_name': "mary jane"},
              {'id': "jamie", 'customer_name': "jamie north"},
@@ -58,7 +70,8 @@ events = [{'sku': "123-ABC-723",
 
 def create_events(event_array, available=None, price=None, tier="General"):
   """ Create events from the array of passed event details. Provides overrides
-for number of available tickets, price and ticket tier."""
+for number of available tickets, price and ticket tier. If the tier of an
+event was sharded, its shards are removed."""
   e_set_key = keynamehelper.create_key_name("events")
   for event in event_array:
     # Override the availability & price if provided
@@ -67,35 +80,341 @@ for number of available tickets, price and ticket tier."""
     if price != None:
       event['price:' + tier] = price
     e_key = keynamehelper.create_key_name("event", event['sku'])
+    shards = shard_count(event['sku'], tier)
+    if shards:
+      redis.delete(*[shard_key(event['sku'], shard)
+                     for shard in range(shards)])
+      redis.hdel(e_key, "shards:" + tier)
     redis.hset(e_key, mapping = event)
     redis.sadd(e_set_key, event['sku'])
 
+# Optimistic locking
+__tx_stats__ = {}
+__tx_lock__ = threading.Lock()
+
+def _record_transaction(key, attempts, conflicts, elapsed, failed):
+  """Add the outcome of a call to transaction to the counters for the key"""
+  from bisect import bisect_left
+
+  with __tx_lock__:
+    stats = __tx_stats__.get(key)
+    if stats is None:
+      stats = {'transactions': 0, 'attempts': 0, 'conflicts': 0, 'retries': 0,
+               'failures': 0, 'latency': [0] * (len(__latency_buckets__) + 1)}
+      __tx_stats__[key] = stats
+    stats['transactions'] += 1
+    stats['attempts'] += attempts
+    stats['conflicts'] += conflicts
+    stats['retries'] += attempts - 1
+    stats['failures'] += 1 if failed else 0
+    stats['latency'][bisect_left(__latency_buckets__, elapsed)] += 1
+
+def transaction(func, key, fields=(), watches=(), deadline=__retry_deadline__):
+  """Run func as an optimistic transaction on the Hash key. key, and any other
+keys in watches, are watched and the fields of key are read with a single
+HMGET. func is then called with a pipeline in MULTI mode and a dict of the
+field values, and queues the commands of the transaction. If func queues no
+commands, nothing is executed.
+
+If a watched key changes before EXEC, the transaction is retried after a random
+backoff of up to __retry_base__ seconds, doubling on each retry up to
+__retry_cap__. Once deadline seconds have passed WatchError is raised. The
+attempts, conflicts, retries and latency of each call are counted for the key,
+see transaction_stats, and a call that raises any exception is counted as a
+failure. Returns the value returned by func."""
+  start = time.time()
+  attempts = 0
+  conflicts = 0
+  succeeded = False
+  try:
+    while True:
+      attempts += 1
+      p = redis.pipeline()
+      try:
+        p.watch(key, *watches)
+        values = p.hmget(key, list(fields)) if fields else []
+        p.multi()
+        result = func(p, dict(zip(fields, values)))
+        if p.command_stack:
+          p.execute()
+        succeeded = True
+        return result
+      except WatchError:
+        conflicts += 1
+        backoff = random.uniform(0, min(__retry_cap__,
+                                        __retry_base__ * 2 ** (attempts - 1)))
+        if time.time() + backoff - start > deadline:
+          raise
+        time.sleep(backoff)
+      finally:
+        p.reset()
+  finally:
+    _record_transaction(key, attempts, conflicts, time.time() - start,
+                        not succeeded)
+
+def transaction_stats(key=None):
+  """Return a copy of the transaction counters for the key, or a dict of the
+counters of every key. The latency histogram has a count for each bucket in
+__latency_buckets__, and a final count for latencies above the last bucket."""
+  with __tx_lock__:
+    copies = {k: dict(v, latency=list(v['latency']))
+              for k, v in __tx_stats__.items() if key is None or k == key}
+  return copies if key is None else copies.get(key)
+
+def print_transaction_stats():
+  """Print the transaction counters of each key"""
+  for key, stats in sorted(transaction_stats().items()):
+    print("{}: transactions:{} attempts:{} conflicts:{} retries:{} "
+          "failures:{}".format(key, stats['transactions'], stats['attempts'],
+                               stats['conflicts'], stats['retries'],
+                               stats['failures']))
+
 # Part One - Check availability and Purchase
 def check_availability_and_purchase(customer, event_sku, qty, tier="General"):
-  """Check if there is sufficient inventory before making the purchase"""
-  p = redis.pipeline()
-  try:
-    e_key = keynamehelper.create_key_name("event", event_sku)
-    redis.watch(e_key)
-    available = int(redis.hget(e_key, "available:" + tier))
-    price = float(redis.hget(e_key, "price:" + tier))
-    if available >= qty:
-      p.hincrby(e_key, "available:" + tier, -qty)
-      order_id = generate.order_id()
-      purchase = {'order_id': order_id, 'customer': customer,
-                  'tier': tier, 'qty': qty, 'cost': qty * price,
-                  'event_sku': event_sku, 'ts': int(time.time())}
-      so_key = keynamehelper.create_key_name("sales_order", order_id)
-      p.hset(so_key, mapping = purchase)
-      p.execute()
-    else:
+  """Check if there is sufficient inventory before making the purchase. If the
+tier of the event is sharded the purchase is made with sharded_purchase.
+Returns the order id if the purchase was made, otherwise None."""
+  e_key = keynamehelper.create_key_name("event", event_sku)
+
+  def buy(p, event):
+    if int(event["shards:" + tier] or 0):
+      return sharded
+    available = int(event["available:" + tier])
+    if available < qty:
       print("Insufficient inventory, have {}, requested {}".format(available,
                                                                    qty))
+      return None
+    price = float(event["price:" + tier])
+    p.hincrby(e_key, "available:" + tier, -qty)
+    order_id = generate.order_id()
+    purchase = {'order_id': order_id, 'customer': customer,
+                'tier': tier, 'qty': qty, 'cost': qty * price,
+                'event_sku': event_sku, 'ts': int(time.time())}
+    so_key = keynamehelper.create_key_name("sales_order", order_id)
+    p.hset(so_key, mapping = purchase)
+    return order_id
+
+  sharded = object()
+  try:
+    order_id = transaction(buy, e_key, ["available:" + tier, "price:" + tier,
+                                        "shards:" + tier])
   except WatchError:
     print("Write Conflict check_availability_and_purchase: {}".format(e_key))
-  finally:
-    p.reset()
-  print("Purchase complete!")
+    return None
+  if order_id is sharded:
+    return sharded_purchase(customer, event_sku, qty, tier)
+  if order_id is not None:
+    print("Purchase complete!")
+  return order_id
+
+# Check available:<tier> and, if there are enough tickets, take them and post
+# the sales order, all in one step on the server. Unlike the WATCH version
+# above, a purchase cannot fail because another buyer changed the event.
+#
+# KEYS[1] is the key of the event Hash.
+# KEYS[2] is the key of the sales order Hash to create.
+# ARGV[1] is the customer, ARGV[2] the quantity, ARGV[3] the ticket tier,
+# ARGV[4] the order id, ARGV[5] the event SKU and ARGV[6] the timestamp.
+# Returns the cost of the order if successful, -1 if the tier is sharded.
+# Otherwise, returns false.
+purchase_script = """
+    local tier = ARGV[3]
+    local qty = tonumber(ARGV[2])
+    if tonumber(redis.call('HGET', KEYS[1], 'shards:' .. tier) or '0') > 0 then
+        return -1
+    end
+    local available = tonumber(redis.call('HGET', KEYS[1], 'available:' .. tier))
+    if available == nil or available < qty then
+        return false
+    end
+    local price = tonumber(redis.call('HGET', KEYS[1], 'price:' .. tier))
+    local cost = tostring(qty * price)
+    redis.call('HINCRBY', KEYS[1], 'available:' .. tier, -qty)
+    redis.call('HSET', KEYS[2], 'order_id', ARGV[4], 'customer', ARGV[1],
+               'tier', tier, 'qty', qty, 'cost', cost,
+               'event_sku', ARGV[5], 'ts', ARGV[6])
+    return cost
+"""
+
+_purchase = None
+
+def purchase(customer, event_sku, qty, tier="General"):
+  """Make the purchase in one round trip with purchase_script. The script is
+loaded into Redis once, and then invoked by its SHA. Returns the order id if
+the purchase was made, otherwise None. If the tier of the event is sharded the
+purchase is made with sharded_purchase."""
+  global _purchase
+  if _purchase is None:
+    _purchase = redis.register_script(purchase_script)
+  e_key = keynamehelper.create_key_name("event", event_sku)
+  order_id = generate.order_id()
+  so_key = keynamehelper.create_key_name("sales_order", order_id)
+  cost = _purchase(keys=[e_key, so_key],
+                   args=[customer, qty, tier, order_id, event_sku,
+                         int(time.time())])
+  if cost == -1:
+    return sharded_purchase(customer, event_sku, qty, tier)
+  if cost is None:
+    print("Insufficient inventory, requested {}".format(qty))
+    return None
+  return order_id
+
+# Sharded inventory. The available tickets of a tier of a hot event are split
+# across several shard Hashes, so buyers on different shards do not contend
+# for the same key. Each shard has its own hash tag, so in a cluster the shards
+# are spread across slots, and every command on a shard uses a single key.
+
+# Take tickets from a shard, if it has enough.
+#
+# KEYS[1] is the key of the shard Hash.
+# ARGV[1] is the ticket tier.
+# ARGV[2] is the number of tickets to take.
+# Returns the price of a ticket if successful. Otherwise, returns false.
+take_tickets_script = """
+    local available = tonumber(redis.call('HGET', KEYS[1], 'available:' .. ARGV[1]))
+    local qty = tonumber(ARGV[2])
+    if available == nil or available < qty then
+        return false
+    end
+    redis.call('HINCRBY', KEYS[1], 'available:' .. ARGV[1], -qty)
+    return redis.call('HGET', KEYS[1], 'price:' .. ARGV[1])
+"""
+
+# Empty a shard.
+#
+# KEYS[1] is the key of the shard Hash.
+# ARGV[1] is the ticket tier.
+# Returns the number of tickets the shard had.
+drain_shard_script = """
+    local field = 'available:' .. ARGV[1]
+    local available = tonumber(redis.call('HGET', KEYS[1], field) or '0')
+    redis.call('HSET', KEYS[1], field, 0)
+    return available
+"""
+
+_take_tickets = None
+_drain_shard = None
+
+def shard_key(event_sku, shard):
+  """Return the key of a shard of the event's inventory"""
+  return keynamehelper.create_key_name("inventory",
+                                       "{{{}:{}}}".format(event_sku, shard))
+
+def take_tickets(s_key, qty, tier="General"):
+  """Take qty tickets from the shard with take_tickets_script. Returns the
+price of a ticket, or None if the shard does not have enough."""
+  global _take_tickets
+  if _take_tickets is None:
+    _take_tickets = redis.register_script(take_tickets_script)
+  price = _take_tickets(keys=[s_key], args=[tier, qty])
+  return None if price is None else float(price)
+
+def shard_inventory(event_sku, shards, tier="General"):
+  """Move the available tickets of the tier of the event into shards shard
+Hashes, split as evenly as possible. The number of shards is recorded in the
+event, in shards:<tier>.
+
+If the tier is already sharded, the tickets in the existing shards are first
+moved back into the event, so it can be resharded to any number of shards.
+While that happens buyers may find the tier sold out, so it is best done when
+no purchases are being made."""
+  global _drain_shard
+  if _drain_shard is None:
+    _drain_shard = redis.register_script(drain_shard_script)
+  e_key = keynamehelper.create_key_name("event", event_sku)
+  old_shards = shard_count(event_sku, tier)
+  for shard in range(old_shards):
+    gathered = _drain_shard(keys=[shard_key(event_sku, shard)], args=[tier])
+    if gathered:
+      redis.hincrby(e_key, "available:" + tier, gathered)
+
+  def split(p, event):
+    available = int(event["available:" + tier])
+    for shard in range(shards):
+      share = available // shards + (1 if shard < available % shards else 0)
+      s_key = shard_key(event_sku, shard)
+      p.hincrby(s_key, "available:" + tier, share)
+      p.hset(s_key, "price:" + tier, event["price:" + tier])
+    for shard in range(shards, old_shards):
+      p.delete(shard_key(event_sku, shard))
+    p.hset(e_key, mapping={'available:' + tier: 0, 'shards:' + tier: shards})
+
+  transaction(split, e_key, ["available:" + tier, "price:" + tier])
+
+def shard_count(event_sku, tier="General"):
+  """Return the number of shards of the tier of the event, or 0 if it is not
+sharded"""
+  e_key = keynamehelper.create_key_name("event", event_sku)
+  return int(redis.hget(e_key, "shards:" + tier) or 0)
+
+def sharded_available(event_sku, tier="General"):
+  """Return the number of tickets available across the shards of the event"""
+  p = redis.pipeline(transaction=False)
+  for shard in range(shard_count(event_sku, tier)):
+    p.hget(shard_key(event_sku, shard), "available:" + tier)
+  return sum(int(available or 0) for available in p.execute())
+
+def rebalance(event_sku, dry, qty, tier="General"):
+  """Move tickets into the dry shard, which does not have qty tickets, from the
+other shards, starting with the one with the most. Half of a shard's tickets
+are moved, or as many as are still needed if more. Each move takes the tickets
+from one shard with take_tickets_script and then adds them to the other, so
+that no command uses more than one key.
+
+Returns False if the shards have fewer than qty tickets between them. Tickets
+being moved by another buyer are in neither shard, so the shards are read a
+second time before giving up."""
+  shards = shard_count(event_sku, tier)
+  short = False
+  while True:
+    p = redis.pipeline(transaction=False)
+    for shard in range(shards):
+      p.hget(shard_key(event_sku, shard), "available:" + tier)
+    levels = [int(available or 0) for available in p.execute()]
+    if sum(levels) < qty:
+      if short:
+        return False
+      short = True
+      continue
+    needed = qty - levels[dry]
+    for donor in sorted(range(shards), key=lambda shard: -levels[shard]):
+      if needed <= 0:
+        break
+      moved = min(levels[donor], max(needed, levels[donor] // 2))
+      if donor == dry or moved == 0:
+        continue
+      # Another buyer may have taken tickets from the donor, if so look again
+      if take_tickets(shard_key(event_sku, donor), moved, tier) is not None:
+        redis.hincrby(shard_key(event_sku, dry), "available:" + tier, moved)
+        needed -= moved
+    return True
+
+def sharded_purchase(customer, event_sku, qty, tier="General"):
+  """Make the purchase from the event's shard for the customer, chosen by a
+hash of the customer. If the shard runs dry, tickets are moved into it from
+the other shards with rebalance. If the tier of the event is not sharded, the
+purchase is made with purchase. Returns the order id if the purchase was made,
+otherwise None."""
+  import zlib
+
+  shards = shard_count(event_sku, tier)
+  if shards == 0:
+    return purchase(customer, event_sku, qty, tier)
+  shard = zlib.crc32(customer.encode("utf-8")) % shards
+  s_key = shard_key(event_sku, shard)
+  price = take_tickets(s_key, qty, tier)
+  while price is None:
+    if not rebalance(event_sku, shard, qty, tier):
+      print("Insufficient inventory, requested {}".format(qty))
+      return None
+    price = take_tickets(s_key, qty, tier)
+  order_id = generate.order_id()
+  order = {'order_id': order_id, 'customer': customer,
+           'tier': tier, 'qty': qty, 'cost': qty * price,
+           'event_sku': event_sku, 'ts': int(time.time())}
+  so_key = keynamehelper.create_key_name("sales_order", order_id)
+  redis.hset(so_key, mapping = order)
+  return order_id
 
 def print_event_details(event_sku):
   """Print the details of the event, based on the passed SKU"""
@@ -122,51 +441,105 @@ def test_check_and_purchase():
   check_availability_and_purchase(requestor, event_requested, 6)
   print_event_details(event_requested)
 
+  # Same again, with the purchase script
+  print("== Request 3 tickets with the purchase script, success")
+  requestor = "bill"
+  order_id = purchase(requestor, event_requested, 3)
+  print_event_details(event_requested)
+  print(redis.hgetall(keynamehelper.create_key_name("sales_order", order_id)))
+
+  print("== Request 3 tickets with the purchase script, failure because of "
+        "insufficient inventory")
+  requestor = "mary"
+  purchase(requestor, event_requested, 3)
+  print_event_details(event_requested)
+
+def test_sharded_purchase():
+  """Test function for sharded inventory"""
+  print("\n==Test 1a: Purchase from sharded inventory")
+  # Create events with 10 tickets available, split across 4 shards
+  create_events(events, available=10)
+  event_requested = "737-DEF-911"
+  shard_inventory(event_requested, 4)
+  print("== Shards: {}".format([redis.hget(shard_key(event_requested, shard),
+                                           "available:General")
+                                for shard in range(4)]))
+
+  print("== Request 2 tickets for each customer, the last two fail")
+  for cust in customers:
+    order_id = sharded_purchase(cust['id'], event_requested, 2)
+    print("{}: {}, available: {}".format(cust['id'], order_id,
+                                        sharded_available(event_requested)))
+
 # Part Two - Reserve stock & Credit Card auth
 def reserve(customer, event_sku, qty, tier="General"):
   """First reserve the inventory and perform a credit authorization. If successful
-then confirm the inventory deduction or back the deducation out."""
-  p = redis.pipeline()
+then confirm the inventory deduction or back the deducation out. A sharded
+tier cannot be reserved."""
+  e_key = keynamehelper.create_key_name("event", event_sku)
+  hold_key = keynamehelper.create_key_name("ticket_hold", event_sku)
+
+  def hold(p, event):
+    if int(event["shards:" + tier] or 0):
+      print("Tier {} of {} is sharded, it cannot be reserved".format(tier,
+                                                                     event_sku))
+      return None
+    available = int(event["available:" + tier])
+    if available < qty:
+      print("Insufficient inventory, have {}, requested {}".format(available,
+                                                                   qty))
+      return None
+    order_id = generate.order_id()
+    ts = int(time.time())
+    p.hincrby(e_key, "available:" + tier, -qty)
+    p.hincrby(e_key, "held:" + tier, qty)
+    # Create a hash to store the seat hold information
+    p.hsetnx(hold_key, "qty:" + order_id, qty)
+    p.hsetnx(hold_key, "tier:" + order_id, tier)
+    p.hsetnx(hold_key, "ts:" + order_id, ts)
+    p.zadd(hold_index_key(), {hold_member(event_sku, order_id): ts})
+    return order_id, float(event["price:" + tier])
+
   try:
-    e_key = keynamehelper.create_key_name("event", event_sku)
-    redis.watch(e_key)
-    available = int(redis.hget(e_key, "available:" + tier))
-    if available >= qty:
-      order_id = generate.order_id()
-      ts = int(time.time())
-      price = float(redis.hget(e_key, "price:" + tier))
-      p.hincrby(e_key, "available:" + tier, -qty)
-      p.hincrby(e_key, "held:" + tier, qty)
-      # Create a hash to store the seat hold information
-      hold_key = keynamehelper.create_key_name("ticket_hold", event_sku)
-      p.hsetnx(hold_key, "qty:" + order_id, qty)
-      p.hsetnx(hold_key, "tier:" + order_id, tier)
-      p.hsetnx(hold_key, "ts:" + order_id, ts)
-      p.execute()
+    held = transaction(hold, e_key, ["available:" + tier, "price:" + tier,
+                                     "shards:" + tier])
   except WatchError:
     print("Write Conflict in reserve: {}".format(e_key))
-  finally:
-    p.reset()
+    return
+  if held is None:
+    return
+  order_id, price = held
   if creditcard_auth(customer, qty * price):
-    try:
-      purchase = {'order_id': order_id, 'customer': customer,
-                  'tier': tier, 'qty': qty, 'cost': qty * price,
-                  'event_sku': event_sku, 'ts': int(time.time())}
-      redis.watch(e_key)
+    purchase = {'order_id': order_id, 'customer': customer,
+                'tier': tier, 'qty': qty, 'cost': qty * price,
+                'event_sku': event_sku, 'ts': int(time.time())}
+
+    def confirm(p, hold):
+      # The hold has expired, and its tickets have been returned
+      if hold["qty:" + order_id] is None:
+        return False
       # Remove the seat hold, since it is no longer needed
       p.hdel(hold_key, "qty:" + order_id,)
       p.hdel(hold_key, "tier:" + order_id)
       p.hdel(hold_key, "ts:" + order_id)
+      p.zrem(hold_index_key(), hold_member(event_sku, order_id))
       # Update the Event
       p.hincrby(e_key, "held:" + tier, -qty)
       # Post the Sales Order
       so_key = keynamehelper.create_key_name("sales_order", order_id)
-      p.hmset(so_key, purchase)
-      p.execute()
+      p.hset(so_key, mapping = purchase)
+      return True
+
+    try:
+      confirmed = transaction(confirm, hold_key, ["qty:" + order_id],
+                              watches=[e_key])
     except WatchError:
       print("Write Conflict in reserve: {}".format(e_key))
-    finally:
-      p.reset()
+      return
+    if not confirmed:
+      print("Hold expired on order {} for customer {}, purchase "
+            "failed".format(order_id, customer))
+      return
     print("Purchase complete!")
   else:
     print("Auth failure on order {} for customer {} ${}".format(order_id,
@@ -174,6 +547,15 @@ then confirm the inventory deduction or back the deducation out."""
                                                                 price * qty))
     backout_hold(event_sku, order_id)
 
+def hold_index_key():
+  """Return the key of the Sorted Set of every ticket hold, across all events,
+scored by the time the hold was made"""
+  return keynamehelper.create_key_name("hold_index")
+
+def hold_member(event_sku, order_id):
+  """Return the member of the hold index for a ticket hold"""
+  return "{}:{}".format(event_sku, order_id)
+
 def creditcard_auth(customer, order_total):
   """Test function to approve/denigh an authorization request"""
   # Always fails Joan's auth
@@ -184,24 +566,28 @@ def creditcard_auth(customer, order_total):
 
 def backout_hold(event_sku, order_id):
   """Remove the ticket reservation"""
-  p = redis.pipeline()
-  try:
-    hold_key = keynamehelper.create_key_name("ticket_hold", event_sku)
-    e_key = keynamehelper.create_key_name("event", event_sku)
-    redis.watch(e_key)
-    qty = int(redis.hget(hold_key, "qty:" + order_id))
-    tier = redis.hget(hold_key, "tier:" + order_id)
+  hold_key = keynamehelper.create_key_name("ticket_hold", event_sku)
+  e_key = keynamehelper.create_key_name("event", event_sku)
+
+  def backout(p, hold):
+    # The hold has already been removed
+    if hold["qty:" + order_id] is None:
+      return
+    qty = int(hold["qty:" + order_id])
+    tier = hold["tier:" + order_id]
     p.hincrby(e_key, "available:" + tier, qty)
     p.hincrby(e_key, "held:" + tier, -qty)
     # Remove the hold, since it is no longer needed
     p.hdel(hold_key, "qty:" + order_id)
     p.hdel(hold_key, "tier:" + order_id)
     p.hdel(hold_key, "ts:" + order_id)
-    p.execute()
+    p.zrem(hold_index_key(), hold_member(event_sku, order_id))
+
+  try:
+    transaction(backout, hold_key, ["qty:" + order_id, "tier:" + order_id],
+                watches=[e_key])
   except WatchError:
     print("Write Conflict in backout_hold: {}".format(e_key))
-  finally:
-    p.reset()
 
 def test_reserve():
   """Test function reserve & credit auth"""
@@ -234,18 +620,82 @@ def create_expired_reservation(event_sku, tier="General"):
           }
   k = keynamehelper.create_key_name("ticket_hold", event_sku)
   redis.hset(k, mapping = holds)
+  redis.zadd(hold_index_key(),
+             {hold_member(event_sku, field[3:]): ts
+              for field, ts in holds.items() if field.startswith("ts:")})
   k = keynamehelper.create_key_name("event", event_sku)
   redis.hset(k, mapping = tickets)
 
-def expire_reservation(event_sku, cutoff_time_secs=30):
-  """ Check if any reservation has exceeded the cutoff time. If any have, then
-backout the reservation and return the inventory back to the pool."""
+# Release a batch of ticket holds, returning their tickets to the events.
+# Holds that have already been released, or turned into a purchase, are only
+# removed from the hold index.
+#
+# KEYS[1] is the key of the hold index.
+# KEYS[2i] is the key of the event of the i'th hold, and KEYS[2i+1] the key of
+# the ticket_hold Hash of the event.
+# ARGV[2i-1] is the member of the i'th hold in the hold index, and ARGV[2i] its
+# order id.
+# Returns the number of holds released.
+release_holds_script = """
+    local released = 0
+    for i = 1, #ARGV / 2 do
+        local e_key = KEYS[2 * i]
+        local hold_key = KEYS[2 * i + 1]
+        local order_id = ARGV[2 * i]
+        local qty = redis.call('HGET', hold_key, 'qty:' .. order_id)
+        if qty then
+            local tier = redis.call('HGET', hold_key, 'tier:' .. order_id)
+            redis.call('HINCRBY', e_key, 'available:' .. tier, qty)
+            redis.call('HINCRBY', e_key, 'held:' .. tier, -qty)
+            redis.call('HDEL', hold_key, 'qty:' .. order_id,
+                       'tier:' .. order_id, 'ts:' .. order_id)
+            released = released + 1
+        end
+        redis.call('ZREM', KEYS[1], ARGV[2 * i - 1])
+    end
+    return released
+"""
+
+_release_holds = None
+
+def release_holds(members):
+  """Release the holds with the members of the hold index, with a single call
+of release_holds_script. Returns the number of holds released."""
+  global _release_holds
+  if _release_holds is None:
+    _release_holds = redis.register_script(release_holds_script)
+  keys = [hold_index_key()]
+  args = []
+  for member in members:
+    event_sku, order_id = member.rsplit(":", 1)
+    keys.append(keynamehelper.create_key_name("event", event_sku))
+    keys.append(keynamehelper.create_key_name("ticket_hold", event_sku))
+    args.extend([member, order_id])
+  return _release_holds(keys=keys, args=args)
+
+def expired_holds(cutoff_time_secs=30, count=__expiry_batch__):
+  """Return the members of the hold index of up to count holds that have
+exceeded the cutoff time, oldest first"""
   cutoff_ts = int(time.time()-cutoff_time_secs)
-  e_key = keynamehelper.create_key_name("ticket_hold", event_sku)
-  for field in redis.hscan_iter(e_key, match="ts:*", count=1000):
-    if int(field[1]) < cutoff_ts:
-      (_, order_id) = field[0].split(":")
-      backout_hold(event_sku, order_id)
+  return redis.zrangebyscore(hold_index_key(), "-inf", "({}".format(cutoff_ts),
+                             start=0, num=count)
+
+def expire_reservations(cutoff_time_secs=30, batch_size=__expiry_batch__):
+  """ Check if any reservation, for any event, has exceeded the cutoff time. If
+any have, then backout the reservation and return the inventory back to the
+pool. Expired holds are read from the hold index with ZRANGEBYSCORE,
+batch_size at a time, and each batch is released with a single call of
+release_holds_script, so the cost depends on the number of expired holds
+rather than the number of holds and events. Returns the number of holds
+released."""
+  released = 0
+  while True:
+    members = expired_holds(cutoff_time_secs, batch_size)
+    if members:
+      released += release_holds(members)
+    if len(members) < batch_size:
+      break
+  return released
 
 def test_expired_res():
   """Test function expired reservations"""
@@ -263,7 +713,7 @@ def test_expired_res():
   h_key = keynamehelper.create_key_name("ticket_hold", event_requested)
   e_key = keynamehelper.create_key_name("event", event_requested)
   while True:
-    expire_reservation(event_requested)
+    expire_reservations()
     outstanding = redis.hmget(h_key, "qty:VPIR6X", "qty:B1BFG7", "qty:UZ1EL0")
     available = redis.hget(e_key, "available:" + tier)
     print("{}, Available:{}, Reservations:{}".format(event_requested,
@@ -288,8 +738,11 @@ def main():
   create_customers(customers)
   # Performs the tests
   test_check_and_purchase()
+  test_sharded_purchase()
   test_reserve()
   test_expired_res()
+  print("\n==Transaction counters")
+  print_transaction_stats()
 
 if __name__ == "__main__":
   keynamehelper.set_prefix("uc02")
@@ -0,0 +1,107 @@
+"""Load test for the purchase functions of the inventory control use case.
+Usage:
+  python loadtest.py [--buyers N] [--purchases N] [--qty N] [--shards N]
+
+Many buyers, each in its own thread, purchase tickets for the same event at
+the same time, first with check_availability_and_purchase, which uses WATCH,
+then with purchase, which uses a Lua script, and last with sharded_purchase,
+from inventory split across shards. For each the throughput, the
+share of purchases that succeeded, the WATCH conflicts and the tickets left are
+reported. The event has enough tickets for every purchase, so a failure is
+always caused by contention.
+
+Part of Redis University RU101 courseware"""
+from redis import Redis
+import contextlib
+import io
+import os
+import sys
+import threading
+import time
+import inventory
+import redisu.utils.keynamehelper as keynamehelper
+
+__methods__ = {'watch': inventory.check_availability_and_purchase,
+               'script': inventory.purchase,
+               'sharded': inventory.sharded_purchase}
+__event_sku__ = "123-ABC-723"
+
+
+def run(method, buyers, purchases, qty):
+  """Start buyers threads that each make purchases purchases of qty tickets
+with the method. Returns the number of purchases that succeeded and the
+elapsed time."""
+  buy = __methods__[method]
+  start = threading.Barrier(buyers + 1)
+  succeeded = [0] * buyers
+
+  def buyer(i):
+    start.wait()
+    for _ in range(purchases):
+      if buy("buyer{}".format(i), __event_sku__, qty) is not None:
+        succeeded[i] += 1
+
+  threads = [threading.Thread(target=keynamehelper.bind(buyer), args=(i,))
+             for i in range(buyers)]
+  for thread in threads:
+    thread.start()
+  # The purchase functions print the outcome of every purchase
+  with contextlib.redirect_stdout(io.StringIO()):
+    start.wait()
+    began = time.time()
+    for thread in threads:
+      thread.join()
+    elapsed = time.time() - began
+  return sum(succeeded), elapsed
+
+def main(argv):
+  """Entry point, to run the load test from the command line"""
+  import argparse
+  from redisu.utils.clean import clean_keys
+
+  parser = argparse.ArgumentParser(
+      description="Load test the inventory control purchase functions")
+  parser.add_argument("--buyers", type=int, default=100,
+                      help="number of concurrent buyers")
+  parser.add_argument("--purchases", type=int, default=20,
+                      help="purchases made by each buyer")
+  parser.add_argument("--qty", type=int, default=1,
+                      help="tickets in each purchase")
+  parser.add_argument("--shards", type=int, default=8,
+                      help="inventory shards for the sharded method")
+  parser.add_argument("--method", action="append", choices=list(__methods__),
+                      help="purchase method to test, may be repeated")
+  args = parser.parse_args(argv)
+
+  inventory.redis = Redis(host=os.environ.get("REDIS_HOST", "localhost"),
+                          port=os.environ.get("REDIS_PORT", 6379),
+                          password=os.environ.get("REDIS_PASSWORD", None),
+                          db=0, decode_responses=True)
+  attempts = args.buyers * args.purchases
+  stock = attempts * args.qty
+  event = [e for e in inventory.events if e['sku'] == __event_sku__]
+  print("{} buyers, {} purchases each of {} tickets".format(
+      args.buyers, args.purchases, args.qty))
+  print("{:<8}{:>14}{:>14}{:>12}{:>12}{:>12}".format(
+      "method", "attempts/sec", "orders/sec", "success", "conflicts", "left"))
+  for method in args.method or list(__methods__):
+    clean_keys(inventory.redis)
+    inventory.create_events(event, available=stock)
+    if method == "sharded":
+      inventory.shard_inventory(__event_sku__, args.shards)
+    e_key = keynamehelper.create_key_name("event", __event_sku__)
+    before = inventory.transaction_stats(e_key) or {'conflicts': 0}
+    succeeded, elapsed = run(method, args.buyers, args.purchases, args.qty)
+    after = inventory.transaction_stats(e_key) or {'conflicts': 0}
+    left = int(inventory.redis.hget(e_key, "available:General"))
+    if method == "sharded":
+      left += inventory.sharded_available(__event_sku__)
+    print("{:<8}{:>14.0f}{:>14.0f}{:>11.1f}%{:>12}{:>12}".format(
+        method, attempts / elapsed, succeeded / elapsed,
+        100.0 * succeeded / attempts, after['conflicts'] - before['conflicts'],
+        left))
+  clean_keys(inventory.redis)
+
+if __name__ == "__main__":
+  keynamehelper.set_prefix("uc02load")
+  main(sys.argv[1:])
@@ -0,0 +1,192 @@
+"""Hold expiry service for the inventory control use case.
+Usage:
+  python sweeper.py [--workers N] [--batch-size N] [--cutoff SECS]
+                    [--duration SECS]
+
+Runs until stopped, releasing ticket holds, for any event, that have exceeded
+the cutoff time. Any number of sweepers can be run. They share a lease in
+Redis, and only the sweeper holding it releases holds, with a pool of worker
+threads that each release a batch at a time. If that sweeper stops, another
+takes over once the lease expires. The lease stops sweepers repeating each
+other's work. A hold can never be released twice in any case, since
+release_holds_script checks that the hold still exists.
+
+Every report interval the sweeper prints, and stores in the sweeper:<instance>
+Hash, whether it holds the lease, the lag, which is how long the oldest hold
+has been expired, and the number of holds reclaimed per second.
+
+Part of Redis University RU101 courseware"""
+from redis import Redis
+import os
+import sys
+import threading
+import time
+import uuid
+import inventory
+import redisu.utils.keynamehelper as keynamehelper
+
+# Renew the lease, if it is still held by the token.
+#
+# KEYS[1] is the key of the lease.
+# ARGV[1] is the token of the sweeper.
+# ARGV[2] is the time to live of the lease in milliseconds.
+# Returns 1 if successful. Otherwise, returns 0.
+renew_lease_script = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+"""
+
+# Give up the lease, if it is still held by the token.
+#
+# KEYS[1] is the key of the lease.
+# ARGV[1] is the token of the sweeper.
+# Returns 1 if successful. Otherwise, returns 0.
+release_lease_script = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+"""
+
+
+class Sweeper(object):
+  """Service that releases expired holds. Up to workers * batch_size expired
+holds are read from the hold index at a time, and released by the workers in
+batches of batch_size. While there are more expired holds the sweeper keeps
+going, otherwise it waits interval seconds before looking again."""
+
+  def __init__(self, workers=4, batch_size=inventory.__expiry_batch__,
+               cutoff_time_secs=30, interval=1.0, lease_ms=10000,
+               report_secs=10):
+    self.workers = workers
+    self.batch_size = batch_size
+    self.cutoff_time_secs = cutoff_time_secs
+    self.interval = interval
+    self.lease_ms = lease_ms
+    self.report_secs = report_secs
+    self.instance = uuid.uuid4().hex[:12]
+    self.leader = False
+    self.lag = 0.0
+    self.reclaimed = 0
+    self.reclaimed_per_sec = 0.0
+    self._lease_key = keynamehelper.create_key_name("sweeper_lease")
+    self._stats_key = keynamehelper.create_key_name("sweeper", self.instance)
+    self._renew = inventory.redis.register_script(renew_lease_script)
+    self._release = inventory.redis.register_script(release_lease_script)
+    self._stop = threading.Event()
+
+  def hold_lease(self):
+    """Take the lease, or renew it if this sweeper already has it. Returns
+True if this sweeper holds the lease."""
+    redis = inventory.redis
+    if self.leader:
+      self.leader = self._renew(keys=[self._lease_key],
+                                args=[self.instance, self.lease_ms]) == 1
+    else:
+      self.leader = bool(redis.set(self._lease_key, self.instance, nx=True,
+                                   px=self.lease_ms))
+    return self.leader
+
+  def measure_lag(self):
+    """Return how many seconds the oldest hold has been expired, or 0"""
+    oldest = inventory.redis.zrange(inventory.hold_index_key(), 0, 0,
+                                    withscores=True)
+    if not oldest:
+      return 0.0
+    return max(0.0, time.time() - oldest[0][1] - self.cutoff_time_secs)
+
+  def sweep(self, pool):
+    """Release one round of expired holds with the workers in pool. Returns
+the number of holds read from the hold index."""
+    members = inventory.expired_holds(self.cutoff_time_secs,
+                                      self.workers * self.batch_size)
+    batches = [members[i:i + self.batch_size]
+               for i in range(0, len(members), self.batch_size)]
+    self.reclaimed += sum(pool.map(keynamehelper.bind(inventory.release_holds),
+                                   batches))
+    return len(members)
+
+  def report(self, elapsed):
+    """Update the reclaimed per second over the last elapsed seconds, and
+print and store the metrics"""
+    self.reclaimed_per_sec = self.reclaimed / elapsed if elapsed else 0.0
+    self.reclaimed = 0
+    metrics = {'leader': int(self.leader), 'lag': round(self.lag, 3),
+               'reclaimed_per_sec': round(self.reclaimed_per_sec, 1),
+               'ts': int(time.time())}
+    p = inventory.redis.pipeline(transaction=False)
+    p.hset(self._stats_key, mapping=metrics)
+    p.expire(self._stats_key, max(60, 3 * self.report_secs))
+    p.execute()
+    print("{} leader:{} lag:{:.1f}s reclaimed:{:.1f}/sec".format(
+        self.instance, self.leader, self.lag, self.reclaimed_per_sec))
+
+  def run(self, duration=None):
+    """Sweep until stop is called, or for duration seconds"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    start = time.time()
+    reported = start
+    with ThreadPoolExecutor(max_workers=self.workers) as pool:
+      try:
+        while not self._stop.is_set():
+          swept = 0
+          if self.hold_lease():
+            self.lag = self.measure_lag()
+            swept = self.sweep(pool)
+          now = time.time()
+          if now - reported >= self.report_secs:
+            self.report(now - reported)
+            reported = now
+          if duration is not None and now - start >= duration:
+            break
+          if swept < self.workers * self.batch_size:
+            self._stop.wait(self.interval)
+      finally:
+        if self.leader:
+          self._release(keys=[self._lease_key], args=[self.instance])
+          self.leader = False
+
+  def stop(self):
+    """Ask the sweeper to stop, after the current round"""
+    self._stop.set()
+
+def main(argv):
+  """Entry point, to run a sweeper from the command line"""
+  import argparse
+
+  parser = argparse.ArgumentParser(description="Release expired ticket holds")
+  parser.add_argument("--workers", type=int, default=4,
+                      help="number of worker threads")
+  parser.add_argument("--batch-size", type=int,
+                      default=inventory.__expiry_batch__,
+                      help="holds released by a worker at a time")
+  parser.add_argument("--cutoff", type=int, default=30,
+                      help="seconds before a hold expires")
+  parser.add_argument("--interval", type=float, default=1.0,
+                      help="seconds to wait when there is nothing to release")
+  parser.add_argument("--lease", type=int, default=10000,
+                      help="time to live of the lease in milliseconds")
+  parser.add_argument("--report", type=int, default=10,
+                      help="seconds between reports of the metrics")
+  parser.add_argument("--duration", type=float, default=None,
+                      help="seconds to run for, by default until stopped")
+  args = parser.parse_args(argv)
+
+  inventory.redis = Redis(host=os.environ.get("REDIS_HOST", "localhost"),
+                          port=os.environ.get("REDIS_PORT", 6379),
+                          password=os.environ.get("REDIS_PASSWORD", None),
+                          db=0, decode_responses=True)
+  sweeper = Sweeper(workers=args.workers, batch_size=args.batch_size,
+                    cutoff_time_secs=args.cutoff, interval=args.interval,
+                    lease_ms=args.lease, report_secs=args.report)
+  try:
+    sweeper.run(duration=args.duration)
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == "__main__":
+  keynamehelper.set_prefix("uc02")
+  main(sys.argv[1:])
@@ -117,11 +117,14 @@ def test_pub_sub():
 
   threads = []
   stop_event = threading.Event()
-  threads.append(threading.Thread(target=listener_sales_analytics,
-                                  args=("sales_order_notify",)))
-  threads.append(threading.Thread(target=listener_events_analytics,
-                                  args=("sales_order_notify",)))
-  threads.append(threading.Thread(target=print_statistics,
+  # bind runs each listener with the key prefix in use by this thread
+  threads.append(threading.Thread(
+      target=keynamehelper.bind(listener_sales_analytics),
+      args=("sales_order_notify",)))
+  threads.append(threading.Thread(
+      target=keynamehelper.bind(listener_events_analytics),
+      args=("sales_order_notify",)))
+  threads.append(threading.Thread(target=keynamehelper.bind(print_statistics),
                                   args=(stop_event,)))
 
   for i in range(len(threads)):
@@ -172,10 +175,12 @@ def test_patterned_subs():
   print("==Test 2: Patterned subscribers - Opening Ceremony Lottery picker")
 
   threads = []
-  threads.append(threading.Thread(target=listener_ceremony_alerter,
-                                  args=("sales_order_notify",)))
-  threads.append(threading.Thread(target=listener_event_alerter,
-                                  args=("sales_order_notify",)))
+  threads.append(threading.Thread(
+      target=keynamehelper.bind(listener_ceremony_alerter),
+      args=("sales_order_notify",)))
+  threads.append(threading.Thread(
+      target=keynamehelper.bind(listener_event_alerter),
+      args=("sales_order_notify",)))
 
   for i in range(len(threads)):
     threads[i].daemon = True
@@ -1 +1 @@
-__all__ = ["dumpload", "keynamehelper", "textincr"]
\ No newline at end of file
+__all__ = ["dumpload", "dumpload_async", "keynamehelper", "snapshot", "textincr"]
\ No newline at end of file
@@ -4,36 +4,88 @@ the defined seperator to achive this
 from redis import StrictRedis
 import os
 import sys
+import time
 import redisu.utils.keynamehelper as keynamehelper
 
 
-def clean_keys(redis_c, prefix=None):
+def _unlink_pages(redis_c, match, count):
+  """Remove the keys matching the pattern on a single connection. The UNLINK
+for each page of keys is pipelined with the SCAN for the next page, so each
+page costs one round trip. Returns the number of keys removed."""
+  removed = 0
+  p = redis_c.pipeline(transaction=False)
+  cursor, keys = redis_c.scan(0, match=match, count=count)
+  while True:
+    if keys:
+      p.unlink(*keys)
+    if cursor == 0:
+      removed += sum(p.execute())
+      break
+    p.scan(cursor, match=match, count=count)
+    res = p.execute()
+    if keys:
+      removed += res[0]
+    cursor, keys = res[-1]
+  return removed
+
+def _unlink_parallel(redis_c, match, count, workers):
+  """Remove the keys matching the pattern, with each page of keys returned by
+SCAN unlinked by one of workers threads, each using its own connection.
+Returns the number of keys removed."""
+  from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+  removed = 0
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    pending = set()
+    cursor = None
+    while cursor != 0:
+      cursor, keys = redis_c.scan(cursor or 0, match=match, count=count)
+      if keys:
+        if len(pending) >= 2 * workers:
+          done, pending = wait(pending, return_when=FIRST_COMPLETED)
+          removed += sum(future.result() for future in done)
+        pending.add(pool.submit(redis_c.unlink, *keys))
+    removed += sum(future.result() for future in pending)
+  return removed
+
+def clean_keys(redis_c, prefix=None, workers=1, count=1000):
   """Remove keys with a given prefix. Stop if the default prefix would result in
   removing all keys. This is used by the various use cases to clean up their
-  tets data before running again."""
+  tets data before running again.
+
+  Keys are removed a SCAN page at a time with UNLINK, which frees large values
+  in the background rather than blocking the server. With workers greater than
+  one, pages are unlinked in parallel over that many connections."""
   key_prefix = prefix if prefix != None else keynamehelper.get_prefix()
-  count = 0
+  count_removed = 0
   if key_prefix != None:
-    count = 0
-    for k in redis_c.scan_iter(match=key_prefix + "*", count=1000):
-      redis_c.delete(k)
-      count += 1
+    if workers > 1:
+      count_removed = _unlink_parallel(redis_c, key_prefix + "*", count,
+                                       workers)
+    else:
+      count_removed = _unlink_pages(redis_c, key_prefix + "*", count)
   else:
     print("No prefix, no way am I going to remove '*' !")
-  return count
+  return count_removed
 
-def main(prefix):
+def main(prefix, workers=1):
   """Entry point, allowing the function to be called from command line
   arguments"""
   redis = StrictRedis(host=os.environ.get("REDIS_HOST", "localhost"),
                       port=os.environ.get("REDIS_PORT", 6379),
                       password=os.environ.get("REDIS_PASSWORD", None),
                       db=0)
-  count = clean_keys(redis, prefix)
-  print("Removed {} keys".format(count))
+  start = time.time()
+  count = clean_keys(redis, prefix, workers=workers)
+  elapsed = time.time() - start
+  print("Removed {} keys ({:.0f} keys/sec)".format(count, count / elapsed
+                                                   if elapsed else 0))
 
 if __name__ == "__main__":
   if len(sys.argv) == 2:
     main(sys.argv[1])
+  elif len(sys.argv) == 3:
+    main(sys.argv[1], int(sys.argv[2]))
   else:
-    print("Wrong number of args, specify the key prefix")
+    print("Wrong number of args, specify the key prefix and optionally the "
+          "number of connections to use")
@@ -1,125 +1,456 @@
-"""Utility to dump and load keys from Redis. Key values are encoded in JSON. In
-this module the following functions are available:
+"""Utility to dump and load keys from Redis. Key values are encoded in JSON, and
+can also be loaded from the binary format of the snapshot module. In this
+module the following functions are available:
 
-  * dump(fn, compress, match)
-  * load(fn, compress)
+  * dump(fn, compress, match, workers, count, chunk_size, checkpoint)
+  * load(fn, compress, batch_cmds, batch_bytes, checkpoint)
 
 """
 from redis import StrictRedis
 import sys
+import time
+try:
+  import redisu.utils.snapshot as snapshot
+except ImportError:
+  # Run as a script, without redisu on the PYTHONPATH
+  import snapshot
 
+# Batching limits used by load, the pipeline is flushed when either is reached
+__batch_cmds__ = 1000
+__batch_bytes__ = 1024 * 1024
+# Maximum number of members sent in a single SADD, RPUSH or ZADD
+__max_variadic__ = 1000
+# Commands used to find the size of a collection when dumping in chunks
+__size_cmds__ = {'hash': "HLEN", 'set': "SCARD", 'zset': "ZCARD", 'list': "LLEN"}
+__scan_cmds__ = {'hash': "hscan", 'set': "sscan", 'zset': "zscan"}
+# How often progress is saved when a checkpoint file is given, in SCAN pages
+# for dump and pipeline flushes for load
+__checkpoint_every__ = 10
 
-def dump(redis, filename="/data/ru101.json", compress=False, match="*"):
-  """Dump matching keys into JSOn file format"""
-  import json
+
+def _text(val):
+  """Return a value read from Redis as a str, whether or not the client was
+created with decode_responses."""
+  return val.decode() if isinstance(val, bytes) else val
+
+def _encode_string(val):
+  """Return the (encoding, value) pair used to store a string in the dump.
+Values that are valid UTF-8 are stored as text ("embstr"), anything else is
+stored base64 encoded ("raw"), whatever the OBJECT ENCODING of the key."""
   import base64
-  import gzip
 
-  count = 0
+  if isinstance(val, str):
+    return "embstr", val
   try:
-    if compress:
-      filen = gzip.open(filename, "wb")
+    return "embstr", val.decode("utf-8")
+  except UnicodeDecodeError:
+    return "raw", base64.b64encode(val).decode("ascii")
+
+def _decode_value(t, val):
+  """Convert a value read from Redis into the form it is stored in the dump"""
+  if t == "hash":
+    return {_text(f): _text(v) for f, v in val.items()}
+  elif t == "zset":
+    return [(_text(m), s) for m, s in val]
+  else:
+    return [_text(m) for m in val]
+
+def _page_steps(p, keys, chunk_size=None):
+  """Generator implementing the fetch of the type, TTL and value of a page of
+keys returned by SCAN. It queues commands on the pipeline p and yields each
+time the pipeline needs to be executed, being sent the results, so that the
+same steps can be driven by a synchronous or an asyncio client. All the
+metadata is read in one round trip and all the values in a second one. If
+chunk_size is set, the size of each collection is read first and any with more
+than chunk_size members are not fetched. Returns the list of records to write
+to the dump, and the list of (type, key, ttl) for the large keys."""
+  for k in keys:
+    p.type(k)
+    p.ttl(k)
+  meta = yield
+  found = [(_text(meta[2 * i]), k, meta[2 * i + 1]) for i, k in enumerate(keys)]
+  large = []
+  if chunk_size is not None:
+    sized = [(t, k, ttl) for t, k, ttl in found if t in __size_cmds__]
+    for t, k, _ in sized:
+      p.execute_command(__size_cmds__[t], k)
+    sizes = yield
+    large = [key for key, size in zip(sized, sizes) if size > chunk_size]
+    found = [key for key in found if key not in large]
+  fetched = []
+  for t, k, ttl in found:
+    if t == "hash":
+      p.hgetall(k)
+    elif t == "set":
+      p.smembers(k)
+    elif t == "zset":
+      p.zrange(k, 0, -1, withscores=True)
+    elif t == "list":
+      p.lrange(k, 0, -1)
+    elif t == "string":
+      p.get(k)
     else:
-      filen = open(filename, "w")
-    for k in redis.scan_iter(match=match, count=1000):
-      obj = {}
-      t = redis.type(k)
-      obj['t'] = t
-      obj['k'] = k
-      obj['ttl'] = redis.ttl(k)
-      if t == "hash":
-        obj['v'] = redis.hgetall(k)
-      elif t == "set":
-        obj['v'] = list(redis.smembers(k))
-      elif t == "zset":
-        obj['v'] = redis.zrange(k, 0, -1, withscores=True)
-      elif t == "list":
-        obj['v'] = redis.lrange(k, 0, -1)
-      elif t == "string":
-        encoding = redis.object("encoding", obj['k'])
-        obj['e'] = encoding
-        if encoding == "embstr":
-          obj['v'] = redis.get(k)
-        elif encoding == "raw":
-          obj['v'] = base64.b64encode(bytearray(redis.get(k)))
-        else:
-          print("got a string encoded as {}".format(encoding))
-          continue
-      else:
+      # The key may have been removed since it was scanned
+      if t != "none":
         print("got a type I don't do: {}".format(t))
-        continue
-      count += 1
-      filen.write(json.dumps(obj))
-      filen.write("\n")
+      continue
+    fetched.append({'t': t, 'k': _text(k), 'ttl': ttl})
+  vals = yield
+  objs = []
+  for obj, val in zip(fetched, vals):
+    # Skip keys that expired or were deleted between the round trips
+    if obj['t'] == "string" and val is not None:
+      obj['e'], obj['v'] = _encode_string(val)
+    elif obj['t'] != "string" and val:
+      obj['v'] = _decode_value(obj['t'], val)
+    else:
+      continue
+    objs.append(obj)
+  return objs, [(t, _text(k), ttl) for t, k, ttl in large]
+
+def _fetch_page(redis, keys, chunk_size=None):
+  """Fetch the records for a page of keys returned by SCAN, see _page_steps"""
+  p = redis.pipeline(transaction=False)
+  steps = _page_steps(p, keys, chunk_size)
+  try:
+    next(steps)
+    while True:
+      steps.send(p.execute())
+  except StopIteration as done:
+    return done.value
+
+def _chunk_command(t, key, pos, chunk_size):
+  """Return the name and arguments of the command that reads the chunk of a
+large collection starting at pos, which is a SCAN cursor or a list index"""
+  if t == "list":
+    return "lrange", (key, pos, pos + chunk_size - 1)
+  return __scan_cmds__[t], (key, pos, None, chunk_size)
+
+def _chunk_result(t, res, pos, chunk_size):
+  """Return the position of the next chunk, or None if this is the last one,
+and the members from the result of the command given by _chunk_command"""
+  if t == "list":
+    return (pos + chunk_size if len(res) == chunk_size else None), res
+  cursor, chunk = res
+  return (cursor if cursor != 0 else None), chunk
+
+def _chunk_record(t, key, ttl, chunk, first):
+  """Return the record for one chunk of a large collection. The first record
+carries the TTL and replaces the key on load, the following ones are marked
+as continuations ('c') and are appended to it."""
+  obj = {'t': t, 'k': key, 'v': _decode_value(t, chunk)}
+  if first:
+    obj['ttl'] = ttl
+  else:
+    obj['c'] = 1
+  return obj
+
+def _stream_key(redis, t, key, ttl, chunk_size):
+  """Generator returning the records for a large collection, read in chunks of
+about chunk_size members with HSCAN, SSCAN, ZSCAN or ranged LRANGE calls."""
+  pos = 0
+  first = True
+  while pos is not None:
+    cmd, args = _chunk_command(t, key, pos, chunk_size)
+    pos, chunk = _chunk_result(t, getattr(redis, cmd)(*args), pos, chunk_size)
+    if chunk:
+      yield _chunk_record(t, key, ttl, chunk, first)
+      first = False
+
+def _scan_pages(redis, match, count, cursor=0):
+  """Generator returning a (cursor, keys) tuple for each page of keys that SCAN
+finds for the pattern, starting from cursor. The cursor returned is the one to
+continue the SCAN from once the page has been handled."""
+  while True:
+    cursor, keys = redis.scan(cursor, match=match, count=count)
+    if keys:
+      yield cursor, keys
+    if cursor == 0:
+      break
+
+def _read_checkpoint(checkpoint, filename):
+  """Return the saved progress from the checkpoint file, or None if there is no
+checkpoint to resume from"""
+  import json
+  import os
+
+  if checkpoint is None or not os.path.exists(checkpoint):
+    return None
+  with open(checkpoint) as filen:
+    progress = json.load(filen)
+  if progress['filename'] != filename:
+    raise ValueError("checkpoint {} is for {}, not {}".format(
+        checkpoint, progress['filename'], filename))
+  return progress
+
+def _write_checkpoint(checkpoint, progress):
+  """Save progress to the checkpoint file. The file is replaced atomically, so
+an interrupted write leaves the previous checkpoint in place."""
+  import json
+  import os
+
+  with open(checkpoint + ".tmp", "w") as filen:
+    json.dump(progress, filen)
+  os.replace(checkpoint + ".tmp", checkpoint)
+
+def dump(redis, filename="/data/ru101.json", compress=False, match="*",
+         workers=1, count=1000, chunk_size=None, checkpoint=None,
+         checkpoint_every=__checkpoint_every__):
+  """Dump the keys matching match, a pattern or a list of patterns, into JSON
+file format, using workers threads. Collections larger than chunk_size are
+written chunk_size members at a time. If checkpoint is set, progress is saved
+to that file every checkpoint_every pages, and an interrupted dump resumes
+from it. Returns the number of keys dumped."""
+  import json
+  import gzip
+  import os
+  import threading
+  from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+  patterns = [match] if isinstance(match, str) else match
+  lock = threading.Lock()
+  state = {'count': 0}
+  start = time.time()
+
+  def dump_page(keys):
+    objs, large = _fetch_page(redis, keys, chunk_size)
+    lines = "".join(json.dumps(obj) + "\n" for obj in objs)
+    with lock:
+      filen.write(lines)
+      state['count'] += len(objs)
+    for t, k, ttl in large:
+      written = False
+      for obj in _stream_key(redis, t, k, ttl, chunk_size):
+        line = json.dumps(obj) + "\n"
+        with lock:
+          filen.write(line)
+        written = True
+      if written:
+        with lock:
+          state['count'] += 1
+
+  def open_output(mode):
+    if compress:
+      return gzip.open(filename, mode + "t")
+    return open(filename, mode)
+
+  def save_checkpoint(pattern_index, cursor):
+    # Wait for the pages in flight, so the file holds every key before cursor
+    for future in pending:
+      future.result()
+    pending.clear()
+    # A gzip file is closed and reopened, to start a new member at the offset
+    filen.close()
+    _write_checkpoint(checkpoint, {'filename': filename,
+                                   'pattern': pattern_index,
+                                   'cursor': cursor,
+                                   'offset': os.path.getsize(filename),
+                                   'count': state['count']})
+    return open_output("a")
+
+  progress = _read_checkpoint(checkpoint, filename)
+  if progress is None:
+    filen = open_output("w")
+    first_pattern, first_cursor = 0, 0
+  else:
+    # Cut the output back to the checkpoint, dropping any partly written pages
+    with open(filename, "r+b") as partial:
+      partial.truncate(progress['offset'])
+    filen = open_output("a")
+    first_pattern, first_cursor = progress['pattern'], progress['cursor']
+    state['count'] = progress['count']
+    print("resuming dump from key {}".format(state['count']))
+  pending = set()
+  try:
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      pages = 0
+      for i in range(first_pattern, len(patterns)):
+        cursor = first_cursor if i == first_pattern else 0
+        for cursor, keys in _scan_pages(redis, patterns[i], count, cursor):
+          # Bound the number of pages held in memory
+          if len(pending) >= 2 * workers:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+              future.result()
+          # Each page is fetched and written by a worker with its own connection
+          pending.add(pool.submit(dump_page, keys))
+          pages += 1
+          if checkpoint is not None and pages % checkpoint_every == 0:
+            if cursor == 0:
+              filen = save_checkpoint(i + 1, 0)
+            else:
+              filen = save_checkpoint(i, cursor)
+      for future in pending:
+        future.result()
+    if checkpoint is not None and os.path.exists(checkpoint):
+      os.remove(checkpoint)
   finally:
     filen.close()
-    print("total keys dumped: {}".format(count))
+    elapsed = time.time() - start
+    print("total keys dumped: {}".format(state['count']))
+    print("dump rate: {:.0f} keys/sec".format(state['count'] / elapsed
+                                              if elapsed else 0))
+  return state['count']
 
-def load(redis, filename="/data/ru101.json", compress=False):
-  """Load keys from file in JSON format"""
-  import json
+def _restore(p, obj):
+  """Queue the commands needed to restore one dumped key onto the pipeline.
+Collections are written with variadic commands, at most __max_variadic__
+members at a time, and continuation records ('c') are appended to the key
+restored by the preceding records rather than replacing it. Returns the number
+of commands queued, or 0 if the key type is not supported."""
   import base64
+
+  key = obj['k']
+  vals = obj['v']
+  cmds = 0
+  # Continuation records of a large key add to what has already been loaded
+  if not obj.get('c'):
+    p.delete(key)
+    cmds += 1
+  if obj['t'] == "hash":
+    p.hset(key, mapping=vals)
+    cmds += 1
+  elif obj['t'] in ("set", "list", "zset"):
+    for i in range(0, len(vals), __max_variadic__):
+      chunk = vals[i:i + __max_variadic__]
+      if obj['t'] == "set":
+        p.sadd(key, *chunk)
+      elif obj['t'] == "list":
+        p.rpush(key, *chunk)
+      else:
+        p.zadd(key, dict(chunk))
+      cmds += 1
+  elif obj['t'] == "string":
+    if obj.get('e') == "raw":
+      p.set(key, base64.b64decode(vals))
+    else:
+      p.set(key, vals)
+    cmds += 1
+  else:
+    print("got a type I don't do: {}".format(obj['t']))
+    return 0
+  if 'ttl' in obj and obj['ttl'] >= 0:
+    p.expire(key, obj['ttl'])
+    cmds += 1
+  return cmds
+
+def _records(filename, compress=False, start=0):
+  """Generator returning a (record, size, position) tuple for each key in a JSON
+dump or a binary snapshot, where size is the number of bytes of the dumped
+record and position is where to start from to read the records after it. For
+a JSON dump that is an offset in the (uncompressed) file, for a snapshot the
+number of records."""
+  import json
   import gzip
 
-  count = 0
+  if snapshot.is_snapshot(filename):
+    position = start
+    for obj, size in snapshot.records(filename, skip=start):
+      position += 1
+      yield obj, size, position
+    return
   if compress:
     filen = gzip.open(filename, "rb")
   else:
-    filen = open(filename, "r")
-  try:
+    filen = open(filename, "rb")
+  with filen:
+    filen.seek(start)
     line = filen.readline()
-    p = redis.pipeline()
     while line:
-      obj = json.loads(line)
-      p.delete(obj['k'])
-      if obj['t'] == "hash":
-        # Needs to be hset but where's the key here?
-        p.hset(obj['k'], mapping = obj['v'])
-      elif obj['t'] == "set":
-        for j in range(len(obj['v'])):
-          p.sadd(obj['k'], obj['v'][j])
-      elif obj['t'] == "zset":
-        for j in range(len(obj['v'])):
-          v, s = obj['v'][j]
-          p.zadd(obj['k'], {v: s})
-      elif obj['t'] == "list":
-        for j in range(len(obj['v'])):
-          p.rpush(obj['k'], obj['v'][j])
-      elif obj['t'] == "string":
-        if obj['e'] == "embstr":
-          p.set(obj['k'], obj['v'])
-        elif obj['e'] == "raw":
-          bin_val = bytearray(base64.b64decode(obj['v']))
-          vals = ["SET", "u8", 0, 0]
-          for i in range(len(bin_val)):
-            vals[2] = i * 8
-            vals[3] = bin_val[i]
-            p.execute_command("BITFIELD", obj['k'], *vals)
-      else:
-        print("got a type I don't do: {}".format(obj['t']))
-        continue
-      if 'ttl' in obj and obj['ttl'] >= 0:
-        p.expire(obj['k'], obj['ttl'])
-      p.execute()
-      count += 1
+      yield json.loads(line), len(line), filen.tell()
       line = filen.readline()
+
+def load(redis, filename="/data/ru101.json", compress=False,
+         batch_cmds=__batch_cmds__, batch_bytes=__batch_bytes__,
+         checkpoint=None, checkpoint_every=__checkpoint_every__):
+  """Load keys from a file in JSON format, or a binary snapshot written by the
+snapshot module. Keys are sent to Redis in batches, using a non-transactional
+pipeline that is flushed once batch_cmds commands or batch_bytes bytes of
+dumped data have been queued.
+
+If checkpoint is set, the position in the file after the last batch sent is
+saved to the checkpoint file every checkpoint_every batches. If that file
+exists when load is called, loading continues from the saved position. The
+checkpoint file is removed once the load is complete."""
+  import os
+
+  count = 0
+  start = time.time()
+  position = 0
+  progress = _read_checkpoint(checkpoint, filename)
+  if progress is not None:
+    position = progress['position']
+    count = progress['count']
+    print("resuming load from key {}".format(count))
+  records = _records(filename, compress, position)
+  try:
+    p = redis.pipeline(transaction=False)
+    queued_cmds = 0
+    queued_bytes = 0
+    batches = 0
+    for obj, size, position in records:
+      cmds = _restore(p, obj)
+      if cmds == 0:
+        continue
+      if not obj.get('c'):
+        count += 1
+      queued_cmds += cmds
+      queued_bytes += size
+      if queued_cmds >= batch_cmds or queued_bytes >= batch_bytes:
+        p.execute()
+        queued_cmds = 0
+        queued_bytes = 0
+        batches += 1
+        if checkpoint is not None and batches % checkpoint_every == 0:
+          _write_checkpoint(checkpoint, {'filename': filename,
+                                         'position': position,
+                                         'count': count})
+    p.execute()
+    if checkpoint is not None and os.path.exists(checkpoint):
+      os.remove(checkpoint)
   finally:
-    filen.close()
+    records.close()
+    elapsed = time.time() - start
     print("total keys loaded: {}".format(count))
+    print("load rate: {:.0f} keys/sec".format(count / elapsed if elapsed else 0))
+  return count
 
-def main(command, datafile):
+def main(argv):
   """Entry point to execute either the dump or load"""
   import os
+  import argparse
+  parser = argparse.ArgumentParser(description="Dump or load Redis keys")
+  parser.add_argument("command", choices=["dump", "load"])
+  parser.add_argument("datafile")
+  parser.add_argument("--compress", action="store_true",
+                      help="gzip the data file")
+  parser.add_argument("--batch-cmds", type=int, default=__batch_cmds__,
+                      help="commands per pipeline flush when loading")
+  parser.add_argument("--batch-bytes", type=int, default=__batch_bytes__,
+                      help="bytes of dumped data per pipeline flush when loading")
+  parser.add_argument("--match", action="append",
+                      help="key pattern to dump, may be repeated to split the "
+                           "keyspace by prefix")
+  parser.add_argument("--workers", type=int, default=1,
+                      help="connections used to fetch keys when dumping")
+  parser.add_argument("--chunk-size", type=int, default=None,
+                      help="dump collections larger than this in chunks")
+  parser.add_argument("--checkpoint",
+                      help="file to save progress to, and resume from if it "
+                           "exists")
+  args = parser.parse_args(argv)
   redis_c = StrictRedis(host=os.environ.get("REDIS_HOST", "localhost"),
                         port=os.environ.get("REDIS_PORT", 6379),
                         password=os.environ.get("REDIS_PASSWORD", None),
                         db=0)
-  if command == "load":
-    load(redis_c, filename=datafile)
-  elif command == "dump":
-    dump(redis_c, filename=datafile)
+  if args.command == "load":
+    load(redis_c, filename=args.datafile, compress=args.compress,
+         batch_cmds=args.batch_cmds, batch_bytes=args.batch_bytes,
+         checkpoint=args.checkpoint)
   else:
-    print("Don't know how to do {}".format(command))
+    dump(redis_c, filename=args.datafile, compress=args.compress,
+         match=args.match or "*", workers=args.workers,
+         chunk_size=args.chunk_size, checkpoint=args.checkpoint)
 
 if __name__ == "__main__":
-  main(sys.argv[1], sys.argv[2])
+  main(sys.argv[1:])
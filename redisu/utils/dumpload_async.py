@@ -0,0 +1,232 @@
+"""asyncio versions of the dump and load functions in dumpload, using
+redis.asyncio. Several pipelines are kept in flight at once, and reading,
+decoding and writing the data file is done in a thread, so that a single
+process can keep a Redis server busy during a large restore. The file formats
+are the same as those used by dumpload. In this module the following functions
+are available:
+
+  * dump(fn, compress, match, count, in_flight, chunk_size)
+  * load(fn, compress, batch_cmds, batch_bytes, in_flight)
+
+"""
+from redis.asyncio import Redis
+import asyncio
+import sys
+import time
+try:
+  import redisu.utils.dumpload as dumpload
+except ImportError:
+  # Run as a script, without redisu on the PYTHONPATH
+  import dumpload
+
+# Number of records read from the data file by the reader thread at a time
+__read_ahead__ = 1000
+
+
+async def _drain(pending, limit):
+  """Wait until fewer than limit tasks are pending, raising any error from the
+tasks that have finished. Returns the tasks still pending."""
+  while len(pending) >= max(limit, 1):
+    done, pending = await asyncio.wait(pending,
+                                       return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+      task.result()
+  return pending
+
+async def _fetch_page(redis, keys, chunk_size=None):
+  """Fetch the records for a page of keys returned by SCAN, see
+dumpload._page_steps"""
+  p = redis.pipeline(transaction=False)
+  steps = dumpload._page_steps(p, keys, chunk_size)
+  try:
+    next(steps)
+    while True:
+      steps.send(await p.execute())
+  except StopIteration as done:
+    return done.value
+
+async def _stream_key(redis, t, key, ttl, chunk_size):
+  """Async generator returning the records for a large collection, see
+dumpload._stream_key"""
+  pos = 0
+  first = True
+  while pos is not None:
+    cmd, args = dumpload._chunk_command(t, key, pos, chunk_size)
+    res = await getattr(redis, cmd)(*args)
+    pos, chunk = dumpload._chunk_result(t, res, pos, chunk_size)
+    if chunk:
+      yield dumpload._chunk_record(t, key, ttl, chunk, first)
+      first = False
+
+async def dump(redis, filename="/data/ru101.json", compress=False, match="*",
+               count=1000, in_flight=8, chunk_size=None):
+  """Dump matching keys into JSON file format. Up to in_flight pages returned
+by SCAN are fetched at the same time, each with pipelined commands, and the
+records are encoded and written to the file by a single writer thread. match
+and chunk_size are as for dumpload.dump."""
+  import json
+  import gzip
+  from concurrent.futures import ThreadPoolExecutor
+
+  patterns = [match] if isinstance(match, str) else match
+  loop = asyncio.get_running_loop()
+  # A single thread keeps the records of a large key in order
+  writer = ThreadPoolExecutor(max_workers=1)
+  state = {'count': 0}
+  start = time.time()
+
+  def write(objs):
+    filen.write("".join(json.dumps(obj) + "\n" for obj in objs))
+
+  async def dump_page(keys):
+    objs, large = await _fetch_page(redis, keys, chunk_size)
+    await loop.run_in_executor(writer, write, objs)
+    state['count'] += len(objs)
+    for t, k, ttl in large:
+      written = False
+      async for obj in _stream_key(redis, t, k, ttl, chunk_size):
+        await loop.run_in_executor(writer, write, [obj])
+        written = True
+      if written:
+        state['count'] += 1
+
+  if compress:
+    filen = gzip.open(filename, "wt")
+  else:
+    filen = open(filename, "w")
+  pending = set()
+  try:
+    for pattern in patterns:
+      cursor = None
+      while cursor != 0:
+        cursor, keys = await redis.scan(cursor or 0, match=pattern, count=count)
+        if keys:
+          pending = await _drain(pending, in_flight)
+          pending.add(asyncio.create_task(dump_page(keys)))
+    pending = await _drain(pending, 1)
+  finally:
+    # Stop fetching pages if dumping failed part way through
+    for task in pending:
+      task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    writer.shutdown()
+    filen.close()
+    elapsed = time.time() - start
+    print("total keys dumped: {}".format(state['count']))
+    print("dump rate: {:.0f} keys/sec".format(state['count'] / elapsed
+                                              if elapsed else 0))
+  return state['count']
+
+def _read_ahead(records):
+  """Return the next __read_ahead__ (record, size, position) tuples, or None at
+the end of the file"""
+  chunk = []
+  for rec in records:
+    chunk.append(rec)
+    if len(chunk) >= __read_ahead__:
+      break
+  return chunk or None
+
+async def load(redis, filename="/data/ru101.json", compress=False,
+               batch_cmds=dumpload.__batch_cmds__,
+               batch_bytes=dumpload.__batch_bytes__, in_flight=8):
+  """Load keys from a JSON dump or binary snapshot. The file is read and
+decoded in a thread, one chunk ahead of the records being sent, and up to
+in_flight pipelines, each of batch_cmds commands or batch_bytes bytes of dumped
+data, are executing at the same time.
+
+Pipelines run on separate connections and so can complete in any order. A
+batch holding the continuation of a large key is only sent once every earlier
+batch has completed, so the chunks of a key are never applied before the first
+one."""
+  loop = asyncio.get_running_loop()
+  count = 0
+  start = time.time()
+  records = dumpload._records(filename, compress)
+  pending = set()
+  next_chunk = None
+  try:
+    p = redis.pipeline(transaction=False)
+    queued_cmds = 0
+    queued_bytes = 0
+    continued = False
+    next_chunk = loop.run_in_executor(None, _read_ahead, records)
+    while True:
+      chunk = await next_chunk
+      if chunk is None:
+        break
+      next_chunk = loop.run_in_executor(None, _read_ahead, records)
+      for obj, size, _ in chunk:
+        cmds = dumpload._restore(p, obj)
+        if cmds == 0:
+          continue
+        if obj.get('c'):
+          continued = True
+        else:
+          count += 1
+        queued_cmds += cmds
+        queued_bytes += size
+        if queued_cmds >= batch_cmds or queued_bytes >= batch_bytes:
+          pending = await _drain(pending, 1 if continued else in_flight)
+          pending.add(asyncio.create_task(p.execute()))
+          p = redis.pipeline(transaction=False)
+          queued_cmds = 0
+          queued_bytes = 0
+          continued = False
+    pending = await _drain(pending, 1 if continued else in_flight)
+    pending.add(asyncio.create_task(p.execute()))
+    pending = await _drain(pending, 1)
+  finally:
+    await asyncio.gather(*pending, return_exceptions=True)
+    # The reader thread must finish with the file before it is closed
+    if next_chunk is not None:
+      await asyncio.gather(next_chunk, return_exceptions=True)
+    records.close()
+    elapsed = time.time() - start
+    print("total keys loaded: {}".format(count))
+    print("load rate: {:.0f} keys/sec".format(count / elapsed if elapsed else 0))
+  return count
+
+def main(argv):
+  """Entry point to execute either the dump or load"""
+  import os
+  import argparse
+  parser = argparse.ArgumentParser(description="Dump or load Redis keys")
+  parser.add_argument("command", choices=["dump", "load"])
+  parser.add_argument("datafile")
+  parser.add_argument("--compress", action="store_true",
+                      help="gzip the data file")
+  parser.add_argument("--in-flight", type=int, default=8,
+                      help="pipelines executing at the same time")
+  parser.add_argument("--batch-cmds", type=int, default=dumpload.__batch_cmds__,
+                      help="commands per pipeline when loading")
+  parser.add_argument("--batch-bytes", type=int,
+                      default=dumpload.__batch_bytes__,
+                      help="bytes of dumped data per pipeline when loading")
+  parser.add_argument("--match", action="append",
+                      help="key pattern to dump, may be repeated")
+  parser.add_argument("--chunk-size", type=int, default=None,
+                      help="dump collections larger than this in chunks")
+  args = parser.parse_args(argv)
+
+  async def run():
+    redis_c = Redis(host=os.environ.get("REDIS_HOST", "localhost"),
+                    port=os.environ.get("REDIS_PORT", 6379),
+                    password=os.environ.get("REDIS_PASSWORD", None),
+                    db=0)
+    try:
+      if args.command == "load":
+        await load(redis_c, filename=args.datafile, compress=args.compress,
+                   batch_cmds=args.batch_cmds, batch_bytes=args.batch_bytes,
+                   in_flight=args.in_flight)
+      else:
+        await dump(redis_c, filename=args.datafile, compress=args.compress,
+                   match=args.match or "*", in_flight=args.in_flight,
+                   chunk_size=args.chunk_size)
+    finally:
+      await redis_c.close()
+
+  asyncio.run(run())
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
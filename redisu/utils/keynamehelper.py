@@ -4,12 +4,31 @@ e.g., by default , given the values "foo" and "bar" as parameters, the functions
 will generate
   "foo:bar"
 
+For hot paths, a KeySchema precomputes the prefix, compiles key templates such
+as "seatmap:{sku}:{tier}:{block}" and caches the key names it builds.
+
+set_prefix and set_sep change the default for the whole process. A KeySchema
+is immutable, and use_schema makes it the one used by the functions in this
+module for the current thread or asyncio task only, so that one process can
+serve several prefixes at once without locking, e.g.
+
+  with use_schema(KeySchema("tenant1")):
+    create_key_name("event", sku)   # "tenant1:event:<sku>"
+
+Threads start without a schema, use bind to run a thread's target with the
+schema of the code that starts it.
+
 Todo:
   * Deal with non-string values, rather than rely upon the caller to make
 into strings
 """
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+import contextvars
+
 __prefix__ = ""
 __sep__ = ":"
+_schema = contextvars.ContextVar("keynamehelper_schema", default=None)
 
 def set_prefix(ch):
   """Set the prefix to use. This is typically the course or unit number"""
@@ -18,7 +37,8 @@ def set_prefix(ch):
 
 def get_prefix():
   """Return the current prefix"""
-  return __prefix__
+  schema = _schema.get()
+  return schema.prefix if schema is not None else __prefix__
 
 def set_sep(ch):
   """Set the seperator to use, the default is defined in the initialization of
@@ -28,7 +48,8 @@ def set_sep(ch):
 
 def get_sep():
   """Return the current seperator."""
-  return __sep__
+  schema = _schema.get()
+  return schema.sep if schema is not None else __sep__
 
 def ensure_str(vals):
   str_vals = []
@@ -44,6 +65,9 @@ def create_key_name(*vals):
 
      [ prefix + separator] + [ [ separator + value] ]
   """
+  schema = _schema.get()
+  if schema is not None:
+    return schema.key(*vals)
   start = ((__prefix__ + __sep__) if (__prefix__ != "") else "")
   return (start + "%s" % __sep__.join(ensure_str(vals)))
 
@@ -55,4 +79,172 @@ def create_field_name(*vals):
   Typically used for field names in a hash, where you don't need the prefix
   added, because the returned value is used in the context of a key.
   """
+  schema = _schema.get()
+  if schema is not None:
+    return schema.field(*vals)
   return "%s" % __sep__.join(ensure_str(vals))
+
+def _cached(func, cache_size):
+  """Return func wrapped in an LRU cache of cache_size entries, or func itself
+  if cache_size is 0"""
+  if cache_size == 0:
+    return func
+  return lru_cache(maxsize=cache_size)(func)
+
+class KeySchema(object):
+  """Key and field name builder for a fixed prefix and separator. The start of
+  every key name is computed once, and key names are cached in a bounded LRU
+  cache of cache_size entries, so repeated names cost a dictionary lookup.
+  Names that are rarely repeated, like those of orders, are built faster with
+  cache_size=0, which turns the cache off.
+
+  e.g., given the prefix "uc02"
+    schema.key("event", "123-ABC-723") returns "uc02:event:123-ABC-723"
+    schema.template("event:{sku}").key(sku="123-ABC-723") returns the same
+  """
+  __slots__ = ("_prefix", "_sep", "_start", "_cache_size", "key", "key_bytes",
+               "field")
+
+  def __init__(self, prefix="", sep=":", cache_size=4096):
+    init = super(KeySchema, self).__setattr__
+    init("_prefix", prefix)
+    init("_sep", sep)
+    init("_start", (prefix + sep) if prefix != "" else "")
+    init("_cache_size", cache_size)
+    init("key", _cached(self._key, cache_size))
+    init("key_bytes", _cached(self._key_bytes, cache_size))
+    init("field", _cached(self._field, cache_size))
+
+  def __setattr__(self, name, value):
+    raise AttributeError("KeySchema is immutable")
+
+  @property
+  def prefix(self):
+    """The prefix added to every key name"""
+    return self._prefix
+
+  @property
+  def sep(self):
+    """The separator between the parts of a name"""
+    return self._sep
+
+  def _key(self, *vals):
+    """Create the key name, as create_key_name does for this prefix"""
+    try:
+      return self._start + self._sep.join(vals)
+    except TypeError:
+      # Only decode when some of the values are bytes
+      return self._start + self._sep.join(ensure_str(vals))
+
+  def _key_bytes(self, *vals):
+    """Create the key name as bytes, ready to send to Redis"""
+    return self.key(*vals).encode()
+
+  def _field(self, *vals):
+    """Create the field name, as create_field_name does"""
+    try:
+      return self._sep.join(vals)
+    except TypeError:
+      return self._sep.join(ensure_str(vals))
+
+  def template(self, pattern):
+    """Return a KeyTemplate for the pattern, whose parts are separated by ":"
+    and whose variable parts are given as {name}, e.g. "event:{sku}" """
+    return KeyTemplate(self, pattern)
+
+  def __repr__(self):
+    return "KeySchema(prefix={!r}, sep={!r})".format(self._prefix, self._sep)
+
+@contextmanager
+def use_schema(schema):
+  """Context manager making schema the KeySchema used by create_key_name,
+  create_field_name, get_prefix and get_sep in the current thread or asyncio
+  task. Passing None restores the process wide prefix and separator."""
+  token = _schema.set(schema)
+  try:
+    yield schema
+  finally:
+    _schema.reset(token)
+
+def current_schema():
+  """Return the KeySchema set with use_schema, or None if the process wide
+  prefix and separator are in use"""
+  return _schema.get()
+
+def bind(func):
+  """Return a function that calls func using the KeySchema current where bind
+  is called. Used for the target of a thread, which would otherwise use the
+  process wide prefix."""
+  schema = _schema.get()
+
+  @wraps(func)
+  def bound(*args, **kwargs):
+    with use_schema(schema):
+      return func(*args, **kwargs)
+  return bound
+
+class KeyTemplate(object):
+  """A key name pattern compiled against a KeySchema. The prefix, separators
+  and fixed parts of the pattern are joined into a single format string when
+  the template is created, and key names built are cached like those of the
+  schema."""
+  __slots__ = ("_format", "key", "key_bytes")
+
+  def __init__(self, schema, pattern, cache_size=None):
+    parts = pattern.split(":")
+    self._format = schema.key(*parts)
+    size = cache_size if cache_size is not None else schema._cache_size
+    self.key = _cached(self._key, size)
+    self.key_bytes = _cached(self._key_bytes, size)
+
+  def _key(self, **vals):
+    """Create the key name from the values for each {name} in the pattern"""
+    return self._format.format(**{k: v.decode() if isinstance(v, bytes) else v
+                                  for k, v in vals.items()})
+
+  def _key_bytes(self, **vals):
+    """Create the key name as bytes, ready to send to Redis"""
+    return self.key(**vals).encode()
+
+  def __repr__(self):
+    return "KeyTemplate({!r})".format(self._format)
+
+def main():
+  """Microbenchmark comparing the cost of a key name from create_key_name with
+  one from a KeySchema and a KeyTemplate. The "miss" cases use a new order id
+  for every call, as for sales_order keys, so the cache never hits."""
+  import timeit
+
+  number = 200000
+  set_prefix("uc03")
+  schema = KeySchema("uc03")
+  uncached = KeySchema("uc03", cache_size=0)
+  seatmap = schema.template("seatmap:{sku}:{tier}:{block}")
+  order_ids = ["{:06X}-{:06X}".format(i, i) for i in range(number * 3)]
+  fn_ids = iter(order_ids)
+  schema_ids = iter(order_ids)
+  uncached_ids = iter(order_ids)
+  cases = [
+      ("create_key_name",
+       lambda: create_key_name("seatmap", "123-ABC-723", "General", "A")),
+      ("KeySchema.key",
+       lambda: schema.key("seatmap", "123-ABC-723", "General", "A")),
+      ("KeySchema.key_bytes",
+       lambda: schema.key_bytes("seatmap", "123-ABC-723", "General", "A")),
+      ("KeyTemplate.key",
+       lambda: seatmap.key(sku="123-ABC-723", tier="General", block="A")),
+      ("KeySchema.key (uncached)",
+       lambda: schema._key("seatmap", "123-ABC-723", "General", "A")),
+      ("create_key_name (miss)",
+       lambda: create_key_name("sales_order", next(fn_ids))),
+      ("KeySchema.key (miss)",
+       lambda: schema.key("sales_order", next(schema_ids))),
+      ("KeySchema.key (no cache)",
+       lambda: uncached.key("sales_order", next(uncached_ids))),
+  ]
+  for name, case in cases:
+    secs = min(timeit.repeat(case, number=number, repeat=3))
+    print("{:28s} {:8.0f} ns/call".format(name, secs / number * 1e9))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,256 @@
+"""Compact binary snapshot format for dumpload. A snapshot is a sequence of
+blocks of length prefixed records, optionally zlib compressed, followed by an
+index of the blocks, so that it can be decoded from an mmap without parsing a
+line of JSON per key. In this module the following functions are available:
+
+  * write(fn, objs, compress, block_size)
+  * records(fn, skip)
+  * is_snapshot(fn)
+  * convert(src, dst, src_compress, compress)
+
+Layout of a snapshot file:
+
+  header  "RU101SNP", version (u8), compression (u8, 0=none, 1=zlib)
+  blocks  each block holds a sequence of records
+  index   per block: offset (u64), stored length (u32), raw length (u32),
+          record count (u32)
+  trailer index offset (u64), block count (u32), "RUIX"
+
+Each record is a type tag (u8, 0x80 set for a continuation record), the key
+(u32 length + bytes), the TTL (i64) and the payload for the type:
+
+  string  the value (u32 length + bytes)
+  hash    count (u32), count lengths (u32), then the count members, which
+          alternate between field and value
+  set     count (u32), count lengths (u32), then the count members
+  list    as for set
+  zset    as for set, followed by count scores (f64)
+
+Storing the lengths of a collection ahead of its members means they are
+decoded with a single struct call rather than one per member. All integers are
+big-endian.
+"""
+import struct
+import sys
+
+__magic__ = b"RU101SNP"
+__index_magic__ = b"RUIX"
+__version__ = 1
+__block_size__ = 1024 * 1024
+__types__ = {'string': 1, 'hash': 2, 'set': 3, 'zset': 4, 'list': 5}
+__names__ = {v: k for k, v in __types__.items()}
+__continuation__ = 0x80
+
+_header = struct.Struct(">8sBB")
+_index_entry = struct.Struct(">QIII")
+_trailer = struct.Struct(">QI4s")
+_u32 = struct.Struct(">I")
+_ttl = struct.Struct(">q")
+
+
+def _pack_bytes(buf, val):
+  """Append a length prefixed byte string to buf"""
+  if not isinstance(val, bytes):
+    val = str(val).encode("utf-8")
+  buf += _u32.pack(len(val))
+  buf += val
+
+def _pack_members(buf, members):
+  """Append a list of byte strings to buf as a count, the length of each member
+and then the members themselves, so they can be sliced out after a single
+unpack of the lengths."""
+  members = [m if isinstance(m, bytes) else str(m).encode("utf-8")
+             for m in members]
+  buf += _u32.pack(len(members))
+  buf += struct.pack(">{}I".format(len(members)), *map(len, members))
+  buf += b"".join(members)
+
+def _pack_record(buf, obj):
+  """Append the binary record for a dumped key to buf. obj is a record in the
+form written by dumpload.dump."""
+  import base64
+
+  t = obj['t']
+  buf.append(__types__[t] | (__continuation__ if obj.get('c') else 0))
+  _pack_bytes(buf, obj['k'])
+  buf += _ttl.pack(obj.get('ttl', -1))
+  vals = obj['v']
+  if t == "string":
+    _pack_bytes(buf, base64.b64decode(vals) if obj.get('e') == "raw" else vals)
+  elif t == "hash":
+    _pack_members(buf, [x for pair in vals.items() for x in pair])
+  elif t == "zset":
+    _pack_members(buf, [member for member, _ in vals])
+    buf += struct.pack(">{}d".format(len(vals)),
+                       *[float(score) for _, score in vals])
+  else:
+    _pack_members(buf, vals)
+
+def _unpack_bytes(data, pos):
+  """Return the length prefixed byte string at pos, and the following pos"""
+  (size,) = _u32.unpack_from(data, pos)
+  pos += _u32.size
+  return data[pos:pos + size], pos + size
+
+def _unpack_members(data, pos):
+  """Return the list of byte strings written by _pack_members at pos, and the
+following pos"""
+  (count,) = _u32.unpack_from(data, pos)
+  pos += _u32.size
+  lengths = struct.unpack_from(">{}I".format(count), data, pos)
+  pos += 4 * count
+  members = []
+  for length in lengths:
+    members.append(data[pos:pos + length])
+    pos += length
+  return members, pos
+
+def _unpack_record(data, pos):
+  """Decode the record at pos. Returns the record, in the same form as a record
+read from a JSON dump but with bytes in place of str, and the following pos."""
+  tag = data[pos]
+  t = __names__[tag & ~__continuation__]
+  key, pos = _unpack_bytes(data, pos + 1)
+  (ttl,) = _ttl.unpack_from(data, pos)
+  pos += _ttl.size
+  if t == "string":
+    vals, pos = _unpack_bytes(data, pos)
+  else:
+    vals, pos = _unpack_members(data, pos)
+    if t == "hash":
+      vals = dict(zip(vals[0::2], vals[1::2]))
+    elif t == "zset":
+      scores = struct.unpack_from(">{}d".format(len(vals)), data, pos)
+      pos += 8 * len(vals)
+      vals = list(zip(vals, scores))
+  obj = {'t': t, 'k': key, 'v': vals}
+  if tag & __continuation__:
+    obj['c'] = 1
+  else:
+    obj['ttl'] = ttl
+  return obj, pos
+
+def write(filename, objs, compress=True, block_size=__block_size__):
+  """Write the records, in the form written by dumpload.dump, to a snapshot
+file. Records are grouped into blocks of about block_size bytes, each of which
+is zlib compressed if compress is set. Returns the number of records
+written."""
+  import zlib
+
+  index = []
+  count = 0
+  with open(filename, "wb") as filen:
+    filen.write(_header.pack(__magic__, __version__, 1 if compress else 0))
+    buf = bytearray()
+    in_block = 0
+
+    def flush_block():
+      data = zlib.compress(bytes(buf)) if compress else bytes(buf)
+      index.append((filen.tell(), len(data), len(buf), in_block))
+      filen.write(data)
+
+    for obj in objs:
+      _pack_record(buf, obj)
+      in_block += 1
+      count += 1
+      if len(buf) >= block_size:
+        flush_block()
+        buf = bytearray()
+        in_block = 0
+    if in_block:
+      flush_block()
+    index_offset = filen.tell()
+    for entry in index:
+      filen.write(_index_entry.pack(*entry))
+    filen.write(_trailer.pack(index_offset, len(index), __index_magic__))
+  return count
+
+def is_snapshot(filename):
+  """Return True if the file is a snapshot rather than a JSON dump"""
+  with open(filename, "rb") as filen:
+    return filen.read(len(__magic__)) == __magic__
+
+def records(filename, skip=0):
+  """Generator returning a (record, size) tuple for each record in a snapshot,
+after the first skip records, where size is the number of bytes the record
+takes uncompressed. The file is mapped into memory and each block is decoded
+with struct, rather than being read and parsed a line at a time. Blocks that
+are skipped entirely are not decoded."""
+  import mmap
+  import zlib
+
+  with open(filename, "rb") as filen:
+    with mmap.mmap(filen.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      magic, version, compressed = _header.unpack_from(mm, 0)
+      if magic != __magic__ or version != __version__:
+        raise ValueError("{} is not a version {} snapshot".format(filename,
+                                                                  __version__))
+      index_offset, blocks, index_magic = _trailer.unpack_from(
+          mm, len(mm) - _trailer.size)
+      if index_magic != __index_magic__:
+        raise ValueError("{} has no snapshot index, it may be "
+                         "truncated".format(filename))
+      for i in range(blocks):
+        offset, length, _, in_block = _index_entry.unpack_from(
+            mm, index_offset + i * _index_entry.size)
+        if skip >= in_block:
+          skip -= in_block
+          continue
+        data = mm[offset:offset + length]
+        if compressed:
+          data = zlib.decompress(data)
+        pos = 0
+        for _ in range(in_block):
+          obj, end = _unpack_record(data, pos)
+          if skip:
+            skip -= 1
+          else:
+            yield obj, end - pos
+          pos = end
+
+def convert(src, dst, src_compress=False, compress=True):
+  """Convert a JSON dump, optionally gzipped, written by dumpload.dump into a
+snapshot file. Returns the number of keys converted."""
+  import json
+  import gzip
+
+  if src_compress:
+    filen = gzip.open(src, "rt")
+  else:
+    filen = open(src, "r")
+  keys = 0
+
+  def objs():
+    nonlocal keys
+    for line in filen:
+      obj = json.loads(line)
+      # A large key is written as several records, only the first is counted
+      if not obj.get('c'):
+        keys += 1
+      yield obj
+
+  try:
+    write(dst, objs(), compress=compress)
+  finally:
+    filen.close()
+  print("total keys converted: {}".format(keys))
+  return keys
+
+def main(argv):
+  """Entry point, to convert a JSON dump into a snapshot from the command
+line"""
+  import argparse
+  parser = argparse.ArgumentParser(
+      description="Convert a JSON dump into a binary snapshot")
+  parser.add_argument("src")
+  parser.add_argument("dst")
+  parser.add_argument("--src-compress", action="store_true",
+                      help="the JSON dump is gzipped")
+  parser.add_argument("--no-compress", action="store_true",
+                      help="do not compress the snapshot blocks")
+  args = parser.parse_args(argv)
+  convert(args.src, args.dst, src_compress=args.src_compress,
+          compress=not args.no_compress)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])